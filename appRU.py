@@ -1,23 +1,26 @@
 import gradio as gr
 import langdetect
-from transformers import AutoModelForCausalLM, AutoTokenizer, AutoProcessor, BarkModel, pipeline, T5EncoderModel, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, AutoProcessor, BarkModel, pipeline, T5EncoderModel, BitsAndBytesConfig, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
 from peft import PeftModel
-from libretranslatepy import LibreTranslateAPI
-import urllib.error
 import soundfile as sf
 import os
 import cv2
 import subprocess
 import json
+import hashlib
+import atexit
+import random
+from collections import OrderedDict
 import torch
-from einops import rearrange
 from TTS.api import TTS
 import whisper
 from datetime import datetime
 from huggingface_hub import snapshot_download
-from diffusers import StableDiffusionPipeline, StableDiffusion3Pipeline, StableDiffusionXLPipeline, StableDiffusionImg2ImgPipeline, StableDiffusionDepth2ImgPipeline, ControlNetModel, StableDiffusionControlNetPipeline, AutoencoderKL, StableDiffusionLatentUpscalePipeline, StableDiffusionUpscalePipeline, StableDiffusionInpaintPipeline, StableDiffusionGLIGENPipeline, AnimateDiffPipeline, AnimateDiffVideoToVideoPipeline, MotionAdapter, StableVideoDiffusionPipeline, I2VGenXLPipeline, StableCascadePriorPipeline, StableCascadeDecoderPipeline, DiffusionPipeline, DPMSolverMultistepScheduler, ShapEPipeline, ShapEImg2ImgPipeline, StableAudioPipeline, AudioLDM2Pipeline, StableDiffusionInstructPix2PixPipeline, StableDiffusionLDM3DPipeline, FluxPipeline, KandinskyPipeline, KandinskyPriorPipeline, KandinskyV22Pipeline, KandinskyV22PriorPipeline, AutoPipelineForText2Image, HunyuanDiTPipeline, LuminaText2ImgPipeline, IFPipeline, IFSuperResolutionPipeline, PixArtAlphaPipeline, PixArtSigmaPipeline, CogVideoXPipeline, LattePipeline, KolorsPipeline, AuraFlowPipeline, WuerstchenDecoderPipeline, WuerstchenPriorPipeline, EulerAncestralDiscreteScheduler
+from diffusers import StableDiffusionPipeline, StableDiffusion3Pipeline, StableDiffusionXLPipeline, StableDiffusionImg2ImgPipeline, StableDiffusionDepth2ImgPipeline, ControlNetModel, StableDiffusionControlNetPipeline, AutoencoderKL, StableDiffusionLatentUpscalePipeline, StableDiffusionUpscalePipeline, StableDiffusionInpaintPipeline, StableDiffusionGLIGENPipeline, AnimateDiffPipeline, AnimateDiffVideoToVideoPipeline, MotionAdapter, StableVideoDiffusionPipeline, I2VGenXLPipeline, StableCascadePriorPipeline, StableCascadeDecoderPipeline, DiffusionPipeline, DPMSolverMultistepScheduler, ShapEPipeline, ShapEImg2ImgPipeline, StableAudioPipeline, AudioLDM2Pipeline, StableDiffusionInstructPix2PixPipeline, StableDiffusionLDM3DPipeline, FluxPipeline, KandinskyPipeline, KandinskyPriorPipeline, KandinskyV22Pipeline, KandinskyV22PriorPipeline, AutoPipelineForText2Image, HunyuanDiTPipeline, LuminaText2ImgPipeline, IFPipeline, IFSuperResolutionPipeline, PixArtAlphaPipeline, PixArtSigmaPipeline, CogVideoXPipeline, LattePipeline, KolorsPipeline, AuraFlowPipeline, WuerstchenDecoderPipeline, WuerstchenPriorPipeline, EulerAncestralDiscreteScheduler, LCMScheduler
 from diffusers.utils import load_image, export_to_video, export_to_gif, export_to_ply, pt_to_pil
 from diffusers.pipelines.wuerstchen import DEFAULT_STAGE_C_TIMESTEPS
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+from diffusers.models.modeling_outputs import AutoencoderKLOutput
 from controlnet_aux import OpenposeDetector, LineartDetector, HEDdetector
 from compel import Compel, ReturnedEmbeddingsType
 import trimesh
@@ -32,10 +35,11 @@ from tqdm import tqdm
 from llama_cpp import Llama
 import requests
 import re
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
-from webdriver_manager.chrome import ChromeDriverManager
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait
+import time
+import threading
+import queue
 from fake_useragent import UserAgent
 from googlesearch import search
 import html2text
@@ -43,6 +47,9 @@ from rembg import remove
 import torchaudio
 from audiocraft.models import MusicGen, AudioGen, MultiBandDiffusion, MAGNeT
 from audiocraft.data.audio import audio_write
+from demucs.pretrained import get_model as get_demucs_pretrained_model
+from demucs.apply import apply_model
+from demucs.audio import save_audio
 import psutil
 import GPUtil
 from cpuinfo import get_cpu_info
@@ -62,6 +69,65 @@ chat_dir = None
 tts_model = None
 whisper_model = None
 audiocraft_model_path = None
+draft_models = OrderedDict()
+draft_models_max_entries = 1
+moondream2_image_cache = OrderedDict()
+moondream2_image_cache_bytes = 0
+moondream2_image_cache_max_bytes = 512 * 1024 ** 2
+web_search_session = None
+web_search_executor = ThreadPoolExecutor(max_workers=8)
+web_search_query_cache = OrderedDict()
+web_search_page_cache = OrderedDict()
+web_search_cache_lock = threading.Lock()
+web_search_cache_ttl = 900
+web_search_query_cache_max_entries = 256
+web_search_page_cache_max_entries = 1024
+libretranslate_url = "http://127.0.0.1:5000"
+translate_session = None
+translate_max_workers = 4
+translate_executor = ThreadPoolExecutor(max_workers=translate_max_workers)
+translate_cache = OrderedDict()
+translate_cache_lock = threading.Lock()
+translate_cache_max_entries = 4096
+history_log_lock = threading.Lock()
+history_log_files = OrderedDict()
+history_log_max_files = 16
+history_log_fsync_every = 8
+history_log_fsync_interval = 5.0
+history_log_sync_timer = None
+tts_executor = ThreadPoolExecutor(max_workers=1)
+tts_speaker_latents = {}
+bark_processor = None
+bark_model = None
+audiocraft_models = OrderedDict()
+audiocraft_max_models = 2
+multiband_diffusion_model = None
+demucs_model = None
+audio_encode_executor = ThreadPoolExecutor(max_workers=4)
+file_hash_cache = {}
+decoded_audio_cache = OrderedDict()
+decoded_audio_cache_dir = os.path.join("temp", "audio_cache")
+decoded_audio_cache_max_bytes = 4 * 1024 ** 3
+deepfloyd_pipelines = None
+deepfloyd_prompt_cache = OrderedDict()
+deepfloyd_stage_i_cache = OrderedDict()
+deepfloyd_stage_ii_cache = OrderedDict()
+deepfloyd_cache_max_entries = 8
+upscale_models = {}
+upscale_prompt_cache_max_entries = 32
+tiled_diffusion_batch_size = 4
+vae_latent_cache = OrderedDict()
+vae_latent_cache_max_entries = 32
+memory_plan_strategies = [
+    (),
+    ("vae_slicing",),
+    ("vae_slicing", "vae_tiling"),
+    ("vae_slicing", "vae_tiling", "attention_slicing", "forward_chunking"),
+    ("vae_slicing", "vae_tiling", "attention_slicing", "forward_chunking", "model_cpu_offload"),
+    ("vae_slicing", "vae_tiling", "attention_slicing", "forward_chunking", "sequential_cpu_offload"),
+]
+memory_plan_corrections = {}
+memory_plan_headroom = 0.9
 
 
 def authenticate(username, password):
@@ -84,43 +150,304 @@ def get_hf_token():
     return None
 
 
-def perform_web_search(query, num_results=5, max_length=500):
-    ua = UserAgent()
-    user_agent = ua.random
+def create_http_session(pool_size=16):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_web_search_session():
+    global web_search_session
+    if web_search_session is None:
+        web_search_session = create_http_session()
+        web_search_session.headers["User-Agent"] = UserAgent().random
+    return web_search_session
+
+
+def get_translate_session():
+    global translate_session
+    if translate_session is None:
+        translate_session = create_http_session(translate_max_workers)
+    return translate_session
+
+
+def translate_chunk(text, source_lang, target_lang, url=None):
+    stripped = text.strip()
+    if not stripped:
+        return text
+    leading = text[:len(text) - len(text.lstrip())]
+    trailing = text[len(text.rstrip()):]
+
+    key = (stripped, source_lang, target_lang)
+    # Chunks are translated on translate_executor threads
+    with translate_cache_lock:
+        translation = translate_cache.get(key)
+        if translation is not None:
+            translate_cache.move_to_end(key)
+    if translation is None:
+        response = get_translate_session().post(f"{url or libretranslate_url}/translate",
+                                                json={"q": stripped, "source": source_lang, "target": target_lang, "format": "text"},
+                                                timeout=120)
+        response.raise_for_status()
+        translation = response.json()["translatedText"]
+        with translate_cache_lock:
+            translate_cache[key] = translation
+            while len(translate_cache) > translate_cache_max_entries:
+                translate_cache.popitem(last=False)
+
+    return leading + translation + trailing
+
+
+def split_translation_chunks(text, max_chars=2000):
+    chunks = []
+    current = ""
+    for part in re.split(r'(\n\s*\n)', text):
+        if current.strip() and part.strip() and len(current) + len(part) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def translate_long_text(text, source_lang, target_lang, url=None, max_chars=2000):
+    chunks = split_translation_chunks(text, max_chars)
+    futures = [translate_executor.submit(translate_chunk, chunk, source_lang, target_lang, url) for chunk in chunks]
+    return "".join(future.result() for future in futures)
+
+
+def get_web_search_cache(cache, key):
+    with web_search_cache_lock:
+        entry = cache.get(key)
+        if entry and time.monotonic() - entry[0] < web_search_cache_ttl:
+            cache.move_to_end(key)
+            return entry[1]
+        cache.pop(key, None)
+        return None
+
+
+def set_web_search_cache(cache, key, value, max_entries):
+    now = time.monotonic()
+    with web_search_cache_lock:
+        cache[key] = (now, value)
+        cache.move_to_end(key)
+        # Drop least recently used entries over the limit and expired entries at the LRU end
+        while cache:
+            oldest_key, (timestamp, _) = next(iter(cache.items()))
+            if len(cache) <= max_entries and now - timestamp < web_search_cache_ttl:
+                break
+            cache.pop(oldest_key)
+
+
+def html_to_text(page_source):
+    h = html2text.HTML2Text()
+    h.ignore_links = True
+    h.ignore_images = True
+    h.ignore_emphasis = True
+    page_text = h.handle(page_source)
+    return re.sub(r'\s+', ' ', page_text).strip()
+
+
+def fetch_page_text(url, timeout=5):
+    page_text = get_web_search_cache(web_search_page_cache, url)
+    if page_text is None:
+        response = get_web_search_session().get(url, timeout=timeout)
+        response.raise_for_status()
+        page_text = html_to_text(response.text)
+        if page_text:
+            set_web_search_cache(web_search_page_cache, url, page_text, web_search_page_cache_max_entries)
+    return page_text
+
+
+def fetch_pages_text(urls, timeout=5):
+    futures = [web_search_executor.submit(fetch_page_text, url, timeout) for url in urls]
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        future.cancel()
+
+    pages_text = []
+    for future in futures:
+        if future in done and future.exception() is None:
+            pages_text.append(future.result())
+    return pages_text
+
+
+def perform_web_search(query, num_results=5, max_length=500, timeout=5):
+    key = (query, num_results, max_length)
+    search_text = get_web_search_cache(web_search_query_cache, key)
+    if search_text is None:
+        urls = list(search(query, num_results=num_results))
+        pages_text = fetch_pages_text(urls, timeout)
+        search_text = " ".join(pages_text)
+        if len(search_text) > max_length:
+            search_text = search_text[:max_length]
+        # Results with failed or timed out pages are not cached, so a transient error is retried next time
+        if search_text and len(pages_text) == len(urls):
+            set_web_search_cache(web_search_query_cache, key, search_text, web_search_query_cache_max_entries)
 
-    options = webdriver.ChromeOptions()
-    options.add_argument(f'user-agent={user_agent}')
-    options.add_argument('--headless')
-    options.add_argument('--disable-images')
-    options.add_argument('--disable-extensions')
-    options.add_argument('--no-sandbox')
-    options.add_argument('--disable-dev-shm-usage')
+    return search_text
+
+
+def sync_history_log(history_log):
+    history_log["file"].flush()
+    os.fsync(history_log["file"].fileno())
+    history_log["pending"] = 0
+    history_log["synced"] = time.monotonic()
+
+
+def close_history_log(log_path):
+    history_log = history_log_files.pop(log_path)
+    if history_log["pending"]:
+        sync_history_log(history_log)
+    history_log["file"].close()
+
+
+def close_history_logs(path_prefix=""):
+    with history_log_lock:
+        for log_path in [log_path for log_path in history_log_files if log_path.startswith(path_prefix)]:
+            close_history_log(log_path)
+
+
+def sync_pending_history_logs():
+    global history_log_sync_timer
+    with history_log_lock:
+        history_log_sync_timer = None
+        for history_log in history_log_files.values():
+            if history_log["pending"]:
+                sync_history_log(history_log)
+
+
+def append_history_log(log_path, entry):
+    global history_log_sync_timer
+    with history_log_lock:
+        history_log = history_log_files.get(log_path)
+        if history_log is None:
+            history_log = {"file": open(log_path, "a", encoding="utf-8"), "pending": 0, "synced": time.monotonic()}
+            history_log_files[log_path] = history_log
+            while len(history_log_files) > history_log_max_files:
+                close_history_log(next(iter(history_log_files)))
+        history_log_files.move_to_end(log_path)
+        history_log["file"].write(json.dumps(entry, ensure_ascii=False) + "\n")
+        history_log["file"].flush()
+        history_log["pending"] += 1
+        if history_log["pending"] >= history_log_fsync_every or time.monotonic() - history_log["synced"] >= history_log_fsync_interval:
+            sync_history_log(history_log)
+        elif history_log_sync_timer is None:
+            # The last entries of an idle log still reach the disk after at most one interval
+            history_log_sync_timer = threading.Timer(history_log_fsync_interval, sync_pending_history_logs)
+            history_log_sync_timer.daemon = True
+            history_log_sync_timer.start()
+
+
+atexit.register(close_history_logs)
+
+
+def read_history_log(log_path):
+    with history_log_lock:
+        if log_path in history_log_files:
+            sync_history_log(history_log_files[log_path])
+        with open(log_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def export_history_log(log_path, history_format="json"):
+    entries = read_history_log(log_path)
+    export_path = f"{os.path.splitext(log_path)[0]}.{history_format}"
+    with open(export_path, "w", encoding="utf-8") as f:
+        if history_format == "json":
+            json.dump(entries, f, ensure_ascii=False, indent=4)
+        else:
+            for entry in entries:
+                if isinstance(entry, list):
+                    f.write("\n".join(entry) + "\n\n")
+                elif isinstance(entry, dict):
+                    f.write(f"Source ({entry['source']['language']}): {entry['source']['text']}\n")
+                    f.write(f"Translation ({entry['translation']['language']}): {entry['translation']['text']}\n\n")
+                else:
+                    f.write(f"{entry}\n\n")
+    return export_path
 
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    driver.set_page_load_timeout(30)
 
-    search_results = []
-    for url in search(query, num_results=num_results):
+def export_history_logs(history_format="json"):
+    exported = 0
+    for root, dirs, files in os.walk("outputs"):
+        for file in files:
+            if file.endswith(".jsonl"):
+                export_history_log(os.path.join(root, file), history_format)
+                exported += 1
+    print(f"Exported {exported} history logs to {history_format}")
+
+
+def get_file_hash(file_path):
+    file_stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+    if key not in file_hash_cache:
+        file_hash = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+        file_hash_cache[key] = file_hash.hexdigest()
+    return file_hash_cache[key]
+
+
+def prune_decoded_audio_cache():
+    cache_files = [os.path.join(decoded_audio_cache_dir, file) for file in os.listdir(decoded_audio_cache_dir)]
+    cache_files.sort(key=os.path.getmtime)
+    total_bytes = sum(os.path.getsize(file) for file in cache_files)
+    for file in cache_files[:-1]:
+        if total_bytes <= decoded_audio_cache_max_bytes:
+            break
+        total_bytes -= os.path.getsize(file)
         try:
-            driver.get(url)
-            page_source = driver.page_source
-            h = html2text.HTML2Text()
-            h.ignore_links = True
-            h.ignore_images = True
-            h.ignore_emphasis = True
-            page_text = h.handle(page_source)
-            page_text = re.sub(r'\s+', ' ', page_text).strip()
-            search_results.append(page_text)
-        except (TimeoutException, NoSuchElementException):
-            continue
+            os.remove(file)
+        except OSError:
+            pass
 
-    driver.quit()
 
-    search_text = " ".join(search_results)
-    if len(search_text) > max_length:
-        search_text = search_text[:max_length]
+def decode_audio_file(audio_path, cache_path, sample_rate, channels):
+    command = ["ffmpeg", "-nostdin", "-v", "error", "-i", audio_path, "-f", "f32le", "-ac", str(channels), "-ar", str(sample_rate), "-"]
+    pcm = subprocess.run(command, capture_output=True, check=True).stdout
+    temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(pcm)
+    os.replace(temp_path, cache_path)
 
-    return search_text
+
+def load_audio_cached(audio_path, sample_rate, channels=1):
+    key = (get_file_hash(audio_path), sample_rate, channels)
+    if key in decoded_audio_cache:
+        decoded_audio_cache.move_to_end(key)
+        return decoded_audio_cache[key]
+
+    os.makedirs(decoded_audio_cache_dir, exist_ok=True)
+    cache_path = os.path.join(decoded_audio_cache_dir, f"{key[0]}_{sample_rate}_{channels}.f32")
+    if not os.path.exists(cache_path):
+        decode_audio_file(audio_path, cache_path, sample_rate, channels)
+        prune_decoded_audio_cache()
+    else:
+        os.utime(cache_path)
+
+    if os.path.getsize(cache_path) == 0:
+        audio = np.zeros((channels, 0), dtype=np.float32)
+    else:
+        audio = np.memmap(cache_path, dtype=np.float32, mode="c").reshape(-1, channels).T
+    decoded_audio_cache[key] = audio
+    while len(decoded_audio_cache) > 64:
+        decoded_audio_cache.popitem(last=False)
+    return audio
+
+
+def get_cached_wav_path(audio_path, sample_rate=16000):
+    wav_path = os.path.join(decoded_audio_cache_dir, f"{get_file_hash(audio_path)}_{sample_rate}_1.wav")
+    if not os.path.exists(wav_path):
+        audio = load_audio_cached(audio_path, sample_rate)
+        temp_path = f"{wav_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        sf.write(temp_path, audio[0], sample_rate, format='wav')
+        os.replace(temp_path, wav_path)
+    return wav_path
 
 
 def remove_bg(src_img_path, out_img_path):
@@ -138,7 +465,7 @@ def remove_bg(src_img_path, out_img_path):
         output_file.write(output_data)
 
 
-def load_model(model_name, model_type, n_ctx=None):
+def load_model(model_name, model_type, n_ctx=512):
     global stop_signal
     if stop_signal:
         return None, None, "Generation stopped"
@@ -161,8 +488,7 @@ def load_model(model_name, model_type, n_ctx=None):
         elif model_type == "llama":
             try:
                 device = "cuda" if torch.cuda.is_available() else "cpu"
-                model = Llama(model_path, n_gpu_layers=-1 if device == "cuda" else 0)
-                model.n_ctx = n_ctx
+                model = Llama(model_path, n_ctx=n_ctx, n_gpu_layers=-1 if device == "cuda" else 0)
                 tokenizer = None
                 return tokenizer, model, None
             except (ValueError, RuntimeError):
@@ -170,6 +496,56 @@ def load_model(model_name, model_type, n_ctx=None):
     return None, None, None
 
 
+def load_draft_model(draft_model_name, model_name, tokenizer):
+    global stop_signal
+    if stop_signal:
+        return None, "Generation stopped"
+    if draft_model_name == model_name:
+        return None, "The draft model must be different from the selected LLM model"
+    # The draft stays resident across chat turns, only the target model is reloaded per request
+    key = (draft_model_name, model_name)
+    if key in draft_models:
+        draft_models.move_to_end(key)
+        return draft_models[key], None
+    draft_tokenizer, draft_model, error_message = load_model(draft_model_name, "transformers")
+    if error_message:
+        return None, error_message
+    if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+        del draft_model
+        torch.cuda.empty_cache()
+        return None, "The draft model must use the same tokenizer as the selected LLM model"
+    draft_models[key] = draft_model
+    while len(draft_models) > draft_models_max_entries:
+        draft_models.popitem(last=False)
+        torch.cuda.empty_cache()
+    return draft_model, None
+
+
+def attach_speculative_decoding_stats(llm_model, draft_model):
+    stats = {"verify_steps": 0, "draft_tokens": 0}
+
+    def count_verify_step(module, args, output):
+        stats["verify_steps"] += 1
+
+    def count_draft_token(module, args, output):
+        stats["draft_tokens"] += 1
+
+    hooks = [llm_model.register_forward_hook(count_verify_step), draft_model.register_forward_hook(count_draft_token)]
+    return stats, hooks
+
+
+def finish_speculative_decoding_stats(stats, new_tokens):
+    accepted_tokens = max(new_tokens - stats["verify_steps"], 0)
+    stats["new_tokens"] = new_tokens
+    stats["accepted_tokens"] = accepted_tokens
+    stats["acceptance_rate"] = accepted_tokens / stats["draft_tokens"] if stats["draft_tokens"] else 0.0
+    stats["tokens_per_verify_step"] = new_tokens / stats["verify_steps"] if stats["verify_steps"] else 0.0
+    info = (f"Speculative decoding: {accepted_tokens}/{stats['draft_tokens']} draft tokens accepted "
+            f"({stats['acceptance_rate']:.1%}), {stats['tokens_per_verify_step']:.2f} tokens per verification step")
+    print(info)
+    return info
+
+
 def load_lora_model(base_model_name, lora_model_name, model_type):
     global stop_signal
     if stop_signal:
@@ -217,22 +593,103 @@ def load_moondream2_model(model_id, revision):
     return model, tokenizer
 
 
+def encode_moondream2_image(model, image_path, revision):
+    global moondream2_image_cache_bytes
+    key = (get_file_hash(image_path), revision)
+    if key in moondream2_image_cache:
+        moondream2_image_cache.move_to_end(key)
+        return moondream2_image_cache[key]
+
+    image = Image.open(image_path)
+    enc_image = model.encode_image(image)
+
+    enc_image_bytes = enc_image.element_size() * enc_image.nelement()
+    if enc_image_bytes <= moondream2_image_cache_max_bytes:
+        moondream2_image_cache[key] = enc_image
+        moondream2_image_cache_bytes += enc_image_bytes
+        while moondream2_image_cache_bytes > moondream2_image_cache_max_bytes:
+            _, evicted = moondream2_image_cache.popitem(last=False)
+            moondream2_image_cache_bytes -= evicted.element_size() * evicted.nelement()
+    return enc_image
+
+
+def get_whisper_model():
+    global whisper_model
+    if whisper_model is None:
+        model = load_whisper_model()
+        if isinstance(model, str):
+            # "Generation stopped" sentinel
+            return None
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        whisper_model = model.to(device)
+    return whisper_model
+
+
+def split_audio_on_silence(audio, sample_rate=16000, frame_ms=30, min_silence_ms=300, max_segment_s=30):
+    frame = sample_rate * frame_ms // 1000
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return [(0, len(audio))]
+
+    rms = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    voiced = rms > max(rms.max() * 10 ** (-35 / 20), 1e-4)
+
+    cuts = []
+    silence_start = None
+    for i, is_voiced in enumerate(voiced):
+        if not is_voiced and silence_start is None:
+            silence_start = i
+        elif is_voiced and silence_start is not None:
+            if i - silence_start >= min_silence_ms // frame_ms:
+                cuts.append((silence_start + i) // 2)
+            silence_start = None
+
+    segments = []
+    max_frames = max_segment_s * 1000 // frame_ms
+    start = 0
+    while start < n_frames:
+        end = min(start + max_frames, n_frames)
+        if end < n_frames:
+            candidates = [cut for cut in cuts if start < cut <= end]
+            if candidates:
+                end = candidates[-1]
+        if voiced[start:end].any():
+            segments.append((start * frame, end * frame if end < n_frames else len(audio)))
+        start = end
+    return segments
+
+
+def transcribe_audio_segments(audio_file_path, batch_size=8):
+    model = get_whisper_model()
+    if model is None:
+        return []
+    audio = load_audio_cached(audio_file_path, whisper.audio.SAMPLE_RATE)[0]
+    segments = split_audio_on_silence(audio)
+    options = whisper.DecodingOptions(fp16=torch.cuda.is_available(), without_timestamps=True)
+
+    transcript = []
+    for i in range(0, len(segments), batch_size):
+        if stop_signal:
+            break
+        batch = segments[i:i + batch_size]
+        mels = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio[start:end]), n_mels=model.dims.n_mels)
+                            for start, end in batch]).to(model.device)
+        for (start, end), result in zip(batch, whisper.decode(model, mels, options)):
+            transcript.append({"start": start / whisper.audio.SAMPLE_RATE, "end": end / whisper.audio.SAMPLE_RATE, "text": result.text.strip()})
+    return transcript
+
+
+def format_transcript(transcript, with_timestamps=False):
+    if with_timestamps:
+        return "\n".join(f"[{segment['start']:.2f} - {segment['end']:.2f}] {segment['text']}" for segment in transcript)
+    return " ".join(segment["text"] for segment in transcript if segment["text"])
+
+
 def transcribe_audio(audio_file_path):
     global stop_signal
     if stop_signal:
         return "Generation stopped"
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    whisper_model_path = "inputs/text/whisper-medium"
-    if not os.path.exists(whisper_model_path):
-        os.makedirs(whisper_model_path, exist_ok=True)
-        url = ("https://openaipublic.azureedge.net/main/whisper/models"
-               "/345ae4da62f9b3d59415adc60127b97c714f32e89e936602e85993674d08dcb1/medium.pt")
-        r = requests.get(url, allow_redirects=True)
-        open(os.path.join(whisper_model_path, "medium.pt"), "wb").write(r.content)
-    model_file = os.path.join(whisper_model_path, "medium.pt")
-    model = whisper.load_model(model_file, device=device)
-    result = model.transcribe(audio_file_path)
-    return result["text"]
+    return format_transcript(transcribe_audio_segments(audio_file_path))
 
 
 def load_tts_model():
@@ -248,6 +705,65 @@ def load_tts_model():
     return TTS(model_path=tts_model_path, config_path=f"{tts_model_path}/config.json")
 
 
+def get_tts_speaker_latents(tts_model, speaker_wav_path):
+    xtts_model = tts_model.synthesizer.tts_model
+    latents_path = f"{os.path.splitext(speaker_wav_path)[0]}.latents.pt"
+    speaker_mtime = os.path.getmtime(speaker_wav_path)
+    # Same conditioning settings as tts() uses, latents computed with other settings are recomputed
+    conditioning = {
+        "gpt_cond_len": xtts_model.config.gpt_cond_len,
+        "gpt_cond_chunk_len": xtts_model.config.gpt_cond_chunk_len,
+        "max_ref_length": xtts_model.config.max_ref_len,
+        "sound_norm_refs": xtts_model.config.sound_norm_refs,
+    }
+
+    latents = tts_speaker_latents.get(speaker_wav_path)
+    if latents is None and os.path.exists(latents_path):
+        latents = torch.load(latents_path, map_location="cpu")
+    if latents is not None and latents.get("conditioning") != conditioning:
+        latents = None
+    if latents is not None and latents["mtime"] != speaker_mtime:
+        if latents["hash"] == get_file_hash(speaker_wav_path):
+            latents["mtime"] = speaker_mtime
+            torch.save(latents, latents_path)
+        else:
+            latents = None
+    if latents is None:
+        gpt_cond_latent, speaker_embedding = xtts_model.get_conditioning_latents(
+            audio_path=[speaker_wav_path], **conditioning
+        )
+        latents = {
+            "conditioning": conditioning,
+            "mtime": speaker_mtime,
+            "hash": get_file_hash(speaker_wav_path),
+            "gpt_cond_latent": gpt_cond_latent.cpu(),
+            "speaker_embedding": speaker_embedding.cpu(),
+        }
+        torch.save(latents, latents_path)
+    tts_speaker_latents[speaker_wav_path] = latents
+
+    return latents["gpt_cond_latent"].to(xtts_model.device), latents["speaker_embedding"].to(xtts_model.device)
+
+
+def synthesize_tts(tts_model, text, speaker_wav, language, temperature, top_p, top_k, speed, repetition_penalty=None, length_penalty=None):
+    xtts_model = tts_model.synthesizer.tts_model
+    gpt_cond_latent, speaker_embedding = get_tts_speaker_latents(tts_model, speaker_wav)
+    output = xtts_model.inference(
+        text,
+        language,
+        gpt_cond_latent,
+        speaker_embedding,
+        temperature=temperature,
+        length_penalty=length_penalty if length_penalty is not None else xtts_model.config.length_penalty,
+        repetition_penalty=repetition_penalty if repetition_penalty is not None else xtts_model.config.repetition_penalty,
+        top_k=top_k,
+        top_p=top_p,
+        speed=speed,
+        enable_text_splitting=True,
+    )
+    return output["wav"]
+
+
 def load_whisper_model():
     global stop_signal
     if stop_signal:
@@ -311,10 +827,38 @@ def load_multiband_diffusion_model():
     return "cuda" if torch.cuda.is_available() else "cpu"
 
 
+def load_lcm_lora_model(stable_diffusion_model_type):
+    lcm_lora_model_name = "latent-consistency/lcm-lora-sdxl" if stable_diffusion_model_type == "SDXL" else "latent-consistency/lcm-lora-sdv1-5"
+    lcm_lora_model_path = os.path.join("inputs", "image", "sd_models", "lora", lcm_lora_model_name.split("/")[-1])
+
+    if not os.path.exists(lcm_lora_model_path):
+        print(f"Downloading LCM-LoRA model: {lcm_lora_model_name}")
+        os.makedirs(lcm_lora_model_path, exist_ok=True)
+        Repo.clone_from(f"https://huggingface.co/{lcm_lora_model_name}", lcm_lora_model_path)
+        print(f"LCM-LoRA model {lcm_lora_model_name} downloaded")
+
+    return lcm_lora_model_path
+
+
+def detect_turbo_compatibility(stable_diffusion_model_name, stable_diffusion_model_type, lora_model_names):
+    model_name = stable_diffusion_model_name.lower()
+    if "turbo" in model_name:
+        return "turbo", f"{'SDXL' if stable_diffusion_model_type == 'SDXL' else 'SD'}-Turbo checkpoint detected"
+    if "lcm" in model_name:
+        return "lcm", "LCM checkpoint detected"
+    if lora_model_names and any("lcm" in lora_model_name.lower() for lora_model_name in lora_model_names):
+        return "lcm", "LCM-LoRA selected"
+    if stable_diffusion_model_type in ["SD", "SDXL"]:
+        return "lcm-lora", "No distilled checkpoint detected, LCM-LoRA applied"
+    return None, f"No distilled checkpoint or LCM-LoRA available for {stable_diffusion_model_type}, Turbo mode skipped"
+
+
 def load_upscale_model(upscale_factor):
     global stop_signal
     if stop_signal:
         return None, "Generation stopped"
+    if upscale_factor in upscale_models:
+        return upscale_models[upscale_factor], None
     original_config_file = None
 
     if upscale_factor == 2:
@@ -348,23 +892,543 @@ def load_upscale_model(upscale_factor):
         )
 
     upscaler.to(device)
-    upscaler.enable_attention_slicing()
     if XFORMERS_AVAILABLE:
         upscaler.enable_xformers_memory_efficient_attention(attention_op=None)
 
     upscaler.upscale_factor = upscale_factor
-    return upscaler
+    if upscale_factor == 2:
+        cache_upscaler_prompt_embeds(upscaler)
+    upscale_models[upscale_factor] = upscaler
+    return upscaler, None
+
+
+def cache_upscaler_prompt_embeds(upscaler):
+    encode_prompt = upscaler._encode_prompt
+    prompt_cache = OrderedDict()
+
+    def cached_encode_prompt(prompt, device, do_classifier_free_guidance, negative_prompt):
+        key = (str(prompt), str(device), do_classifier_free_guidance, str(negative_prompt))
+        if key in prompt_cache:
+            prompt_cache.move_to_end(key)
+            return prompt_cache[key]
+        prompt_embeds = encode_prompt(prompt, device, do_classifier_free_guidance, negative_prompt)
+        prompt_cache[key] = prompt_embeds
+        while len(prompt_cache) > upscale_prompt_cache_max_entries:
+            prompt_cache.popitem(last=False)
+        return prompt_embeds
+
+    upscaler._encode_prompt = cached_encode_prompt
+
+
+def enable_vae_encode_cache(pipe, vae_key):
+    encode = pipe.vae.encode
+
+    def cached_encode(x, return_dict=True):
+        # The preprocessed tensor already reflects the resize target, so its bytes identify the encoding
+        image_hash = hashlib.sha1(x.detach().cpu().numpy().tobytes()).hexdigest()
+        key = (vae_key, tuple(x.shape), str(x.dtype), image_hash)
+        if key in vae_latent_cache:
+            vae_latent_cache.move_to_end(key)
+            parameters = vae_latent_cache[key].to(x.device)
+        else:
+            parameters = encode(x).latent_dist.parameters
+            vae_latent_cache[key] = parameters.cpu()
+            while len(vae_latent_cache) > vae_latent_cache_max_entries:
+                vae_latent_cache.popitem(last=False)
+
+        posterior = DiagonalGaussianDistribution(parameters)
+        if not return_dict:
+            return (posterior,)
+        return AutoencoderKLOutput(latent_dist=posterior)
+
+    pipe.vae.encode = cached_encode
+
+
+def get_free_memory(device):
+    if device.type == "cuda":
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        # Blocks held by the PyTorch caching allocator are free for this process too
+        return free_memory + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    return psutil.virtual_memory().available
+
+
+def get_module_bytes(module, device=None):
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors
+               if device is None or tensor.device.type == device.type)
+
+
+def get_pipeline_modules(pipe):
+    return [module for module in pipe.components.values() if isinstance(module, torch.nn.Module)]
+
+
+def estimate_memory_peak(pipe, width, height, num_frames=1, batch_size=1, decode_batch_size=None, guidance=True):
+    # Rough fp16 activation model of a latent diffusion UNet and its VAE decoder, corrected per task by
+    # the peaks observed in record_memory_peak
+    modules = get_pipeline_modules(pipe)
+    module_bytes = [get_module_bytes(module) for module in modules]
+    layer_bytes = [get_module_bytes(layer) for module in modules for layer in module.modules()
+                   if not any(True for _ in layer.children())]
+    dtype_size = torch.finfo(pipe.dtype).bits // 8
+
+    latent_tokens = (int(width) // 8) * (int(height) // 8)
+    unet_images = batch_size * num_frames * (2 if guidance else 1)
+    unet = unet_images * latent_tokens * 320 * dtype_size * 96
+    if XFORMERS_AVAILABLE or hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        attention = unet_images * latent_tokens * 320 * dtype_size * 4
+    else:
+        attention = unet_images * 8 * latent_tokens ** 2 * dtype_size
+
+    decode_images = decode_batch_size or batch_size * num_frames
+    vae_image = int(width) * int(height) * 128 * dtype_size * 12
+    tile_size = getattr(getattr(pipe, "vae", None), "tile_sample_min_size", 512)
+    return {
+        "weights": sum(module_bytes),
+        "largest_module": max(module_bytes, default=0),
+        "largest_layer": max(layer_bytes, default=0),
+        "unet": unet,
+        "attention": attention,
+        "vae": decode_images * vae_image,
+        "vae_image": vae_image,
+        "vae_tile": min(vae_image, tile_size ** 2 * 128 * dtype_size * 12),
+    }
+
+
+def get_memory_plan_peak(estimate, strategy):
+    if "sequential_cpu_offload" in strategy:
+        weights = estimate["largest_layer"]
+    elif "model_cpu_offload" in strategy:
+        weights = estimate["largest_module"]
+    else:
+        weights = estimate["weights"]
+    unet = estimate["unet"] * (0.75 if "forward_chunking" in strategy else 1.0)
+    attention = estimate["attention"] / (2 if "attention_slicing" in strategy else 1)
+    vae = estimate["vae_image"] if "vae_slicing" in strategy else estimate["vae"]
+    if "vae_tiling" in strategy:
+        vae = min(vae, estimate["vae_tile"])
+    return weights + max(unet + attention, vae)
+
+
+def get_memory_plan_options(pipe, device):
+    vae = getattr(pipe, "vae", None)
+    unet = getattr(pipe, "unet", None)
+    options = set()
+    if hasattr(vae, "enable_slicing"):
+        options.add("vae_slicing")
+    if hasattr(vae, "enable_tiling"):
+        options.add("vae_tiling")
+    if hasattr(pipe, "enable_attention_slicing"):
+        options.add("attention_slicing")
+    if hasattr(unet, "enable_forward_chunking"):
+        options.add("forward_chunking")
+    if device.type == "cuda":
+        if pipe.model_cpu_offload_seq is not None:
+            options.add("model_cpu_offload")
+        options.add("sequential_cpu_offload")
+    return options
+
+
+def apply_memory_plan(pipe, strategy, device):
+    # Only the difference to the previous plan is applied: pipelines can be resident across requests, and
+    # disabling attention slicing would also reset xFormers attention processors
+    previous = getattr(pipe, "memory_plan", ())
+    vae = getattr(pipe, "vae", None)
+    unet = getattr(pipe, "unet", None)
+
+    for option, enable, disable in [
+        ("vae_slicing", lambda: vae.enable_slicing(), lambda: vae.disable_slicing()),
+        ("vae_tiling", lambda: vae.enable_tiling(), lambda: vae.disable_tiling()),
+        ("attention_slicing", lambda: pipe.enable_attention_slicing(), lambda: pipe.disable_attention_slicing()),
+        ("forward_chunking", lambda: unet.enable_forward_chunking(),
+         lambda: unet.disable_forward_chunking() if hasattr(unet, "disable_forward_chunking") else None),
+    ]:
+        if option in strategy and option not in previous:
+            enable()
+        elif option in previous and option not in strategy:
+            disable()
+
+    offload = next((option for option in strategy if option.endswith("cpu_offload")), None)
+    previous_offload = next((option for option in previous if option.endswith("cpu_offload")), None)
+    if offload != previous_offload or offload is None:
+        if previous_offload is not None:
+            pipe.remove_all_hooks()
+        if offload == "model_cpu_offload":
+            pipe.enable_model_cpu_offload(device=device)
+        elif offload == "sequential_cpu_offload":
+            pipe.enable_sequential_cpu_offload(device=device)
+        else:
+            pipe.to(device)
+    pipe.memory_plan = strategy
+
+
+def free_resident_models(keep=None):
+    # Models kept resident between requests of other tabs, released before a pipeline has to fall back to
+    # slower memory savings
+    global deepfloyd_pipelines, bark_processor, bark_model, multiband_diffusion_model, demucs_model, whisper_model
+    freed = []
+    for upscale_factor in [factor for factor, upscaler in upscale_models.items() if upscaler is not keep]:
+        del upscale_models[upscale_factor]
+        freed.append(f"upscale-x{upscale_factor}")
+    if deepfloyd_pipelines is not None and keep not in deepfloyd_pipelines:
+        deepfloyd_pipelines = None
+        freed.append("deepfloyd-if")
+    for cache in (deepfloyd_prompt_cache, deepfloyd_stage_i_cache, deepfloyd_stage_ii_cache):
+        cache.clear()
+    if bark_model is not None:
+        bark_processor = bark_model = None
+        freed.append("bark")
+    if audiocraft_models:
+        freed.extend(model_name for model_name, _ in audiocraft_models)
+        audiocraft_models.clear()
+    if multiband_diffusion_model is not None:
+        multiband_diffusion_model = None
+        freed.append("multiband-diffusion")
+    if demucs_model is not None:
+        demucs_model = None
+        freed.append("demucs")
+    if whisper_model is not None:
+        whisper_model = None
+        freed.append("whisper")
+    if draft_models:
+        freed.extend(draft_model_name for draft_model_name, _ in draft_models)
+        draft_models.clear()
+    if freed:
+        torch.cuda.empty_cache()
+    return freed
+
+
+def plan_memory(pipe, task, width, height, num_frames=1, batch_size=1, decode_batch_size=None, guidance=True,
+                force=()):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    estimate = estimate_memory_peak(pipe, width, height, num_frames, batch_size, decode_batch_size, guidance)
+    options = get_memory_plan_options(pipe, device) | set(force)
+    correction = memory_plan_corrections.get(task, 1.0)
+    # Weights of this pipeline that already live on the device are part of the budget
+    available = get_free_memory(device) + sum(get_module_bytes(module, device) for module in get_pipeline_modules(pipe))
+
+    strategies = []
+    for strategy in memory_plan_strategies:
+        strategy = tuple(option for option in strategy if option in options)
+        strategy += tuple(option for option in force if option not in strategy)
+        if strategy not in strategies:
+            strategies.append(strategy)
+    if device.type == "cuda" and get_memory_plan_peak(estimate, strategies[0]) * correction > available * memory_plan_headroom:
+        # Evicting resident models of other tabs is cheaper than a slower strategy for every request
+        freed = free_resident_models(keep=pipe)
+        if freed:
+            available = get_free_memory(device) + sum(
+                get_module_bytes(module, device) for module in get_pipeline_modules(pipe))
+            print(f"Memory plan for {task}: freed resident models {', '.join(freed)}")
+    for strategy in strategies:
+        peak = get_memory_plan_peak(estimate, strategy) * correction
+        if peak <= available * memory_plan_headroom:
+            break
+    else:
+        print(f"Memory plan for {task}: no strategy fits into the available memory, using the most conservative one")
+
+    apply_memory_plan(pipe, strategy, device)
+    print(f"Memory plan for {task}: {', '.join(strategy) or 'no memory savings'} "
+          f"(estimated peak {peak / 1024 ** 3:.2f} GB, available {available / 1024 ** 3:.2f} GB on {device.type})")
+
+    plan = {"task": task, "strategy": strategy, "estimate": peak / correction, "device": device}
+    if device.type == "cuda":
+        plan["baseline"] = torch.cuda.memory_allocated(device) - sum(
+            get_module_bytes(module, device) for module in get_pipeline_modules(pipe))
+        torch.cuda.reset_peak_memory_stats(device)
+    return plan
+
+
+def record_memory_peak(plan):
+    if plan is None or plan["device"].type != "cuda":
+        return
+    observed = torch.cuda.max_memory_allocated(plan["device"]) - plan["baseline"]
+    # Exponential moving average of observed / estimated peak, applied to the next estimate of this task
+    correction = 0.5 * memory_plan_corrections.get(plan["task"], 1.0) + 0.5 * observed / max(plan["estimate"], 1)
+    memory_plan_corrections[plan["task"]] = min(max(correction, 0.25), 4.0)
+    print(f"Memory plan for {plan['task']}: observed peak {observed / 1024 ** 3:.2f} GB, "
+          f"estimated {plan['estimate'] / 1024 ** 3:.2f} GB")
+
+
+def get_tile_offsets(size, tile_size, tile_overlap):
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - tile_overlap
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def get_tile_weights(tile_height, tile_width, tile_overlap, device, dtype):
+    ramp = tile_overlap + 1
+
+    def edge_weights(size):
+        positions = torch.arange(size, device=device, dtype=torch.float32)
+        return torch.minimum(torch.minimum(positions + 1, size - positions), torch.tensor(float(ramp), device=device)) / ramp
+
+    return (edge_weights(tile_height)[:, None] * edge_weights(tile_width)[None, :]).to(dtype)
+
+
+@torch.no_grad()
+def generate_tiled_diffusion_image(pipe, prompt_embeds, negative_prompt_embeds, num_inference_steps, guidance_scale,
+                                   width, height, tile_size=768, tile_overlap=128, init_image=None, strength=1.0,
+                                   pooled_prompt_embeds=None, negative_pooled_prompt_embeds=None, latents=None,
+                                   start_step=0, generator=None):
+    # MultiDiffusion: every step the UNet only sees overlapping native-size latent tiles, whose noise
+    # predictions are blended with feathered weights before a single scheduler step on the full latent
+    device = pipe._execution_device
+    dtype = pipe.unet.dtype
+    scaling_factor = pipe.vae.config.scaling_factor
+    vae_dtype = torch.float32 if getattr(pipe.vae.config, "force_upcast", False) else pipe.vae.dtype
+    pipe.vae.to(dtype=vae_dtype)
+    pipe.enable_vae_tiling()
+
+    pipe.scheduler.set_timesteps(num_inference_steps, device=device)
+    timesteps = pipe.scheduler.timesteps
+    extra_step_kwargs = pipe.prepare_extra_step_kwargs(generator, 0.0)
+
+    if latents is not None:
+        # Resume from a latent snapshot taken before step `start_step` of the same schedule
+        latents = latents.to(device=device, dtype=dtype)
+        height, width = latents.shape[-2] * 8, latents.shape[-1] * 8
+        t_start = start_step * pipe.scheduler.order
+        timesteps = timesteps[t_start:]
+        if hasattr(pipe.scheduler, "set_begin_index"):
+            pipe.scheduler.set_begin_index(t_start)
+    elif init_image is not None:
+        init_image = init_image.to(device=device, dtype=vae_dtype)
+        height, width = init_image.shape[-2:]
+        init_latents = pipe.vae.encode(init_image).latent_dist.sample() * scaling_factor
+        init_latents = init_latents.to(dtype)
+        init_steps = min(int(num_inference_steps * strength), num_inference_steps)
+        t_start = max(num_inference_steps - init_steps, 0) * pipe.scheduler.order
+        timesteps = timesteps[t_start:]
+        if hasattr(pipe.scheduler, "set_begin_index"):
+            pipe.scheduler.set_begin_index(t_start)
+        latents = pipe.scheduler.add_noise(init_latents, torch.randn_like(init_latents), timesteps[:1])
+    else:
+        latents = torch.randn((1, pipe.unet.config.in_channels, height // 8, width // 8), generator=generator,
+                              device=generator.device if generator is not None else device, dtype=dtype).to(device)
+        latents = latents * pipe.scheduler.init_noise_sigma
+
+    latent_height, latent_width = latents.shape[-2:]
+    tile_height = min(tile_size // 8, latent_height)
+    tile_width = min(tile_size // 8, latent_width)
+    latent_overlap = min(tile_overlap // 8, tile_height // 2, tile_width // 2)
+    tiles = [(y, x) for y in get_tile_offsets(latent_height, tile_height, latent_overlap)
+             for x in get_tile_offsets(latent_width, tile_width, latent_overlap)]
+    tile_weights = get_tile_weights(tile_height, tile_width, latent_overlap, device, dtype)
+
+    do_classifier_free_guidance = guidance_scale > 1.0
+    noise_sum = torch.zeros_like(latents)
+    weight_sum = torch.zeros_like(latents)
+
+    for t in timesteps:
+        if stop_signal:
+            return None
+
+        latent_model_input = pipe.scheduler.scale_model_input(latents, t)
+        noise_sum.zero_()
+        weight_sum.zero_()
+
+        for i in range(0, len(tiles), tiled_diffusion_batch_size):
+            batch_tiles = tiles[i:i + tiled_diffusion_batch_size]
+            tile_count = len(batch_tiles)
+            tile_input = torch.cat([latent_model_input[:, :, y:y + tile_height, x:x + tile_width]
+                                    for y, x in batch_tiles])
+            encoder_hidden_states = prompt_embeds.repeat(tile_count, 1, 1)
+            added_cond_kwargs = None
+            if pooled_prompt_embeds is not None:
+                time_ids = torch.tensor([[height, width, y * 8, x * 8, tile_height * 8, tile_width * 8]
+                                         for y, x in batch_tiles], device=device, dtype=dtype)
+                added_cond_kwargs = {"text_embeds": pooled_prompt_embeds.repeat(tile_count, 1), "time_ids": time_ids}
+
+            if do_classifier_free_guidance:
+                tile_input = torch.cat([tile_input] * 2)
+                encoder_hidden_states = torch.cat([negative_prompt_embeds.repeat(tile_count, 1, 1), encoder_hidden_states])
+                if added_cond_kwargs is not None:
+                    added_cond_kwargs = {
+                        "text_embeds": torch.cat([negative_pooled_prompt_embeds.repeat(tile_count, 1),
+                                                  added_cond_kwargs["text_embeds"]]),
+                        "time_ids": torch.cat([added_cond_kwargs["time_ids"]] * 2),
+                    }
+
+            noise_pred = pipe.unet(tile_input, t, encoder_hidden_states=encoder_hidden_states,
+                                   added_cond_kwargs=added_cond_kwargs).sample
+            if do_classifier_free_guidance:
+                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+            for (y, x), tile_noise in zip(batch_tiles, noise_pred):
+                noise_sum[:, :, y:y + tile_height, x:x + tile_width] += tile_noise * tile_weights
+                weight_sum[:, :, y:y + tile_height, x:x + tile_width] += tile_weights
+
+        latents = pipe.scheduler.step(noise_sum / weight_sum, t, latents, **extra_step_kwargs).prev_sample
+
+    image = pipe.vae.decode(latents.to(vae_dtype) / scaling_factor, return_dict=False)[0]
+    return pipe.image_processor.postprocess(image, output_type="pil")[0]
 
 
 stop_signal = False
 
 chat_history = []
+chat_token_counts = {}
+
+
+def get_token_counter(tokenizer=None, llm_model=None):
+    if tokenizer is not None:
+        tokenizer_key = tokenizer.name_or_path
+
+        def encode(text):
+            return len(tokenizer.encode(text, add_special_tokens=False))
+    elif llm_model is not None:
+        tokenizer_key = llm_model.model_path
+
+        def encode(text):
+            return len(llm_model.tokenize(text.encode("utf-8"), add_bos=False))
+    else:
+        tokenizer_key = None
+
+        def encode(text):
+            return len(text) // 4 + 1
+
+    def count_tokens(text):
+        if not text:
+            return 0
+        key = (tokenizer_key, text)
+        if key not in chat_token_counts:
+            if len(chat_token_counts) > 10000:
+                chat_token_counts.clear()
+            chat_token_counts[key] = encode(text)
+        return chat_token_counts[key]
+
+    return count_tokens
+
+
+def get_chat_context_budget(context_token_budget, generation_tokens, tokenizer=None, llm_model=None):
+    # The prompt and the generated tokens have to fit into the model's context window together
+    if tokenizer is not None:
+        context_window = getattr(llm_model.config, "max_position_embeddings", None) or tokenizer.model_max_length
+    else:
+        context_window = llm_model.n_ctx()
+        metadata = llm_model.metadata or {}
+        trained_context = metadata.get(f"{metadata.get('general.architecture')}.context_length")
+        if trained_context:
+            context_window = min(context_window, int(trained_context))
+    return max(min(int(context_token_budget), int(context_window) - int(generation_tokens)), 0)
+
+
+def build_chat_context(prompt, instruction, count_tokens, context_token_budget, ai_prefix="AI", search_results=None):
+    remaining = int(context_token_budget) - count_tokens(instruction) - count_tokens(f"Human: {prompt}\n{ai_prefix}:")
+
+    if search_results:
+        search_budget = max(remaining // 2, 0)
+        search_tokens = count_tokens(search_results)
+        while search_results and search_tokens > search_budget:
+            search_results = search_results[:int(len(search_results) * search_budget / search_tokens)]
+            search_tokens = count_tokens(search_results)
+        remaining -= search_tokens
+
+    context_lines = []
+    for human_text, ai_text in reversed(chat_history):
+        if human_text is None:
+            # Status lines of the app (errors, speculative decoding stats) are not part of the conversation
+            continue
+        turn = ""
+        if human_text:
+            turn += f"Human: {human_text}\n"
+        if ai_text:
+            turn += f"{ai_prefix}: {ai_text}\n"
+        turn_tokens = count_tokens(turn)
+        if turn_tokens > remaining:
+            break
+        remaining -= turn_tokens
+        context_lines.append(turn)
+
+    return "".join(reversed(context_lines)), search_results
+
+
+def create_chat_dir():
+    global chat_dir
+    if not chat_dir:
+        now = datetime.now()
+        close_history_logs(os.path.join('outputs', 'LLM_'))
+        chat_dir = os.path.join('outputs', f"LLM_{now.strftime('%Y%m%d_%H%M%S')}")
+        os.makedirs(chat_dir)
+        os.makedirs(os.path.join(chat_dir, 'text'))
+        os.makedirs(os.path.join(chat_dir, 'audio'))
+    return chat_dir
+
+
+def split_sentences(text_buffer):
+    sentences = re.split(r'(?<=[.!?…])\s+', text_buffer)
+    return [sentence for sentence in sentences[:-1] if sentence.strip()], sentences[-1]
+
+
+def synthesize_tts_sentence(tts_model, sentence, tts_kwargs, chunk_path, audio_chunk_queue=None):
+    wav = synthesize_tts(tts_model, sentence.strip(), **tts_kwargs)
+    sf.write(chunk_path, wav, 22050)
+    if audio_chunk_queue is not None:
+        audio_chunk_queue.put(chunk_path)
+    return wav
+
+
+class StopSignalCriteria(StoppingCriteria):
+    # Lets the Stop button end llm_model.generate, also when it runs in the TTS streaming thread
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), stop_signal, dtype=torch.bool, device=input_ids.device)
+
+
+def stream_tts_sentences(token_stream, tts_model, tts_kwargs, audio_chunk_queue=None):
+    chunk_prefix = os.path.join(create_chat_dir(), 'audio', f"TTS_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    text = ""
+    text_buffer = ""
+    futures = []
+
+    def submit_sentence(sentence):
+        chunk_path = f"{chunk_prefix}_part{len(futures):03d}.wav"
+        futures.append(tts_executor.submit(synthesize_tts_sentence, tts_model, sentence, tts_kwargs, chunk_path, audio_chunk_queue))
+
+    for token_text in token_stream:
+        if stop_signal:
+            break
+        text += token_text
+        text_buffer += token_text
+        sentences, text_buffer = split_sentences(text_buffer)
+        for sentence in sentences:
+            submit_sentence(sentence)
+    if text_buffer.strip() and not stop_signal:
+        submit_sentence(text_buffer)
+
+    return text, [future.result() for future in futures]
+
+
+def generate_text_and_speech_stream(*args):
+    audio_chunk_queue = queue.Queue()
+    result = {}
+
+    def run_chat():
+        result["value"] = generate_text_and_speech(*args, audio_chunk_queue=audio_chunk_queue)
+
+    chat_thread = threading.Thread(target=run_chat)
+    chat_thread.start()
+    streamed = False
+    while chat_thread.is_alive() or not audio_chunk_queue.empty():
+        try:
+            chunk_path = audio_chunk_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        streamed = True
+        yield chat_history, chunk_path
+    chat_thread.join()
+
+    if "value" not in result:
+        yield chat_history, None
+        return
+    yield result["value"][0], None if streamed else result["value"][1]
 
 
 def generate_text_and_speech(input_text, input_audio, input_image, llm_model_name, llm_lora_model_name, llm_settings_html, llm_model_type, max_length, max_tokens,
-                             temperature, top_p, top_k, chat_history_format, enable_web_search, enable_libretranslate, target_lang, enable_multimodal, enable_tts, tts_settings_html,
-                             speaker_wav, language, tts_temperature, tts_top_p, tts_top_k, tts_speed, output_format, stop_generation):
-    global chat_history, chat_dir, tts_model, whisper_model, stop_signal
+                             temperature, top_p, top_k, context_token_budget, llm_draft_model_name, num_assistant_tokens, chat_history_format, enable_web_search, enable_libretranslate, target_lang, enable_multimodal, enable_tts, tts_settings_html,
+                             speaker_wav, language, tts_temperature, tts_top_p, tts_top_k, tts_speed, output_format, stop_generation, audio_chunk_queue=None):
+    global tts_model, stop_signal
     stop_signal = False
     if not input_text and not input_audio:
         chat_history.append(["Please, enter your request!", None])
@@ -382,8 +1446,7 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
         model, tokenizer = load_moondream2_model(model_id, revision)
 
         try:
-            image = Image.open(input_image)
-            enc_image = model.encode_image(image)
+            enc_image = encode_moondream2_image(model, input_image, revision)
 
             detect_lang = langdetect.detect(prompt)
             if detect_lang == "en":
@@ -391,12 +1454,7 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
             else:
                 bot_instruction = "Вы дружелюбный чат-бот, который всегда дает полезные и содержательные ответы на основе данного изображения и текстового ввода."
 
-            context = ""
-            for human_text, ai_text in chat_history[-5:]:
-                if human_text:
-                    context += f"Human: {human_text}\n"
-                if ai_text:
-                    context += f"AI: {ai_text}\n"
+            context, _ = build_chat_context(prompt, bot_instruction, get_token_counter(tokenizer=tokenizer), context_token_budget)
 
             prompt_with_context = f"{bot_instruction}\n\n{context}Human: {prompt}\nAI:"
 
@@ -406,12 +1464,7 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
             del tokenizer
             torch.cuda.empty_cache()
 
-        if not chat_dir:
-            now = datetime.now()
-            chat_dir = os.path.join('outputs', f"LLM_{now.strftime('%Y%m%d_%H%M%S')}")
-            os.makedirs(chat_dir)
-            os.makedirs(os.path.join(chat_dir, 'text'))
-            os.makedirs(os.path.join(chat_dir, 'audio'))
+        create_chat_dir()
         chat_history_path = os.path.join(chat_dir, 'text', f'chat_history.{chat_history_format}')
         if chat_history_format == "txt":
             with open(chat_history_path, "a", encoding="utf-8") as f:
@@ -419,27 +1472,29 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                 if text:
                     f.write(f"AI: {text}\n\n")
         elif chat_history_format == "json":
-            chat_history = []
-            if os.path.exists(chat_history_path):
-                with open(chat_history_path, "r", encoding="utf-8") as f:
-                    chat_history = json.load(f)
-            chat_history.append(["Human: " + prompt, "AI: " + (text if text else "")])
-            with open(chat_history_path, "w", encoding="utf-8") as f:
-                json.dump(chat_history, f, ensure_ascii=False, indent=4)
+            append_history_log(f"{chat_history_path}l", ["Human: " + prompt, "AI: " + (text if text else "")])
 
         chat_history.append([prompt, text])
         return chat_history, None, chat_dir, None
     else:
-        tokenizer, llm_model, error_message = load_model(llm_model_name, llm_model_type)
+        tokenizer, llm_model, error_message = load_model(llm_model_name, llm_model_type,
+                                                         n_ctx=int(context_token_budget) + int(max_tokens))
         if llm_lora_model_name:
             tokenizer, llm_model, error_message = load_lora_model(llm_model_name, llm_lora_model_name, llm_model_type)
         if error_message:
             chat_history.append([None, error_message])
             return chat_history, None, None, None
+        draft_model = None
+        speculative_decoding_info = None
+        if llm_draft_model_name and llm_model_type == "transformers":
+            draft_model, error_message = load_draft_model(llm_draft_model_name, llm_model_name, tokenizer)
+            if error_message:
+                chat_history.append([None, error_message])
+                return chat_history, None, None, None
         tts_model = None
-        whisper_model = None
         text = None
         audio_path = None
+        tts_wavs = None
 
         try:
             if enable_tts:
@@ -450,11 +1505,10 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                     return chat_history, None, None, None
                 device = "cuda" if torch.cuda.is_available() else "cpu"
                 tts_model = tts_model.to(device)
-            if input_audio:
-                if not whisper_model:
-                    whisper_model = load_whisper_model()
-                device = "cuda" if torch.cuda.is_available() else "cpu"
-                whisper_model = whisper_model.to(device)
+            tts_kwargs = dict(speaker_wav=f"inputs/audio/voices/{speaker_wav}", language=language,
+                              temperature=tts_temperature, top_p=tts_top_p, top_k=tts_top_k, speed=tts_speed,
+                              repetition_penalty=2.0, length_penalty=1.0)
+            enable_tts_pipeline = enable_tts and not enable_libretranslate
             if llm_model:
                 if llm_model_type == "transformers":
                     detect_lang = langdetect.detect(prompt)
@@ -463,19 +1517,19 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                     else:
                         bot_instruction = "Вы дружелюбный чат-бот, который всегда дает полезные и содержательные ответы на любом языке"
 
-                    context = ""
-                    for human_text, ai_text in chat_history[-10:]:
-                        if human_text:
-                            context += f"Human: {human_text}\n"
-                        if ai_text:
-                            context += f"AI: {ai_text}\n"
+                    search_results = perform_web_search(prompt) if enable_web_search else None
+                    context, search_results = build_chat_context(
+                        prompt, bot_instruction, get_token_counter(tokenizer=tokenizer),
+                        get_chat_context_budget(context_token_budget, max_length, tokenizer=tokenizer, llm_model=llm_model),
+                        search_results=search_results)
 
+                    prompt_with_search = f"{prompt}\nWeb search results:\n{search_results}" if search_results else prompt
                     messages = [
                         {
                             "role": "system",
                             "content": bot_instruction,
                         },
-                        {"role": "user", "content": context + prompt},
+                        {"role": "user", "content": context + prompt_with_search},
                     ]
 
                     tokenizer.padding_side = "left"
@@ -488,16 +1542,7 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                     progress_bar = tqdm(total=max_length, desc="Generating text")
                     progress_tokens = 0
 
-                    if enable_web_search:
-                        search_results = perform_web_search(prompt)
-                        prompt_with_search = f"{prompt}\nWeb search results:\n{search_results}"
-                        messages[1]["content"] = context + prompt_with_search
-                        model_inputs = tokenizer.apply_chat_template(messages, add_generation_prompt=True, padding=True,
-                                                                     return_tensors="pt").to(device)
-                        input_length = model_inputs.shape[1]
-
-                    generated_ids = llm_model.generate(
-                        model_inputs,
+                    generate_kwargs = dict(
                         do_sample=True,
                         max_new_tokens=max_length,
                         top_p=top_p,
@@ -506,14 +1551,48 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                         repetition_penalty=1.1,
                         num_beams=5,
                         no_repeat_ngram_size=2,
+                        stopping_criteria=StoppingCriteriaList([StopSignalCriteria()]),
                     )
+                    hooks = []
+                    if draft_model:
+                        draft_model.generation_config.num_assistant_tokens = int(num_assistant_tokens)
+                        draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+                        generate_kwargs.update(assistant_model=draft_model, num_beams=1)
+                        stats, hooks = attach_speculative_decoding_stats(llm_model, draft_model)
+
+                    try:
+                        if enable_tts_pipeline:
+                            generate_kwargs["num_beams"] = 1
+                            streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+                            generation = {}
+
+                            def run_generation():
+                                try:
+                                    generation["ids"] = llm_model.generate(model_inputs, streamer=streamer, **generate_kwargs)
+                                finally:
+                                    streamer.end()
+
+                            generation_thread = threading.Thread(target=run_generation)
+                            generation_thread.start()
+                            _, tts_wavs = stream_tts_sentences(streamer, tts_model, tts_kwargs, audio_chunk_queue)
+                            generation_thread.join()
+                            if "ids" not in generation:
+                                raise RuntimeError("Text generation failed")
+                            generated_ids = generation["ids"]
+                        else:
+                            generated_ids = llm_model.generate(model_inputs, **generate_kwargs)
+                    finally:
+                        for hook in hooks:
+                            hook.remove()
+                    if draft_model:
+                        speculative_decoding_info = finish_speculative_decoding_stats(stats, generated_ids.shape[1] - input_length)
 
                     progress_tokens = max_length
                     progress_bar.update(progress_tokens - progress_bar.n)
 
                     if stop_signal:
                         chat_history.append([prompt, "Generation stopped"])
-                        return chat_history, None, None
+                        return chat_history, None, None, None
 
                     progress_bar.close()
 
@@ -526,20 +1605,18 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                     else:
                         instruction = "Я чат-бот, созданный для помощи по любым вопросам. Я использую свои знания и способности, чтобы давать полезные и содержательные ответы на любом языке\n\n"
 
-                    context = ""
-                    for human_text, ai_text in chat_history[-10:]:
-                        if human_text:
-                            context += f"Human: {human_text}\n"
-                        if ai_text:
-                            context += f"Assistant: {ai_text}\n"
+                    search_results = perform_web_search(prompt) if enable_web_search else None
+                    context, search_results = build_chat_context(
+                        prompt, instruction, get_token_counter(llm_model=llm_model),
+                        get_chat_context_budget(context_token_budget, max_tokens, llm_model=llm_model),
+                        ai_prefix="Assistant", search_results=search_results)
 
                     prompt_with_context = instruction + context + "Human: " + prompt + "\nAssistant: "
 
                     progress_bar = tqdm(total=max_tokens, desc="Generating text")
                     progress_tokens = 0
 
-                    if enable_web_search:
-                        search_results = perform_web_search(prompt)
+                    if search_results:
                         prompt_with_context = f"{prompt_with_context}\nWeb search results:\n{search_results}\nAssistant: "
 
                     output = llm_model(
@@ -551,14 +1628,19 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                         top_p=top_p,
                         top_k=top_k,
                         repeat_penalty=1.1,
+                        stream=enable_tts_pipeline,
                     )
+                    if enable_tts_pipeline:
+                        token_stream = (chunk['choices'][0]['text'] for chunk in output)
+                        streamed_text, tts_wavs = stream_tts_sentences(token_stream, tts_model, tts_kwargs, audio_chunk_queue)
+                        output = {'choices': [{'text': streamed_text}]}
 
                     progress_tokens = max_tokens
                     progress_bar.update(progress_tokens - progress_bar.n)
 
                     if stop_signal:
                         chat_history.append([prompt, "Generation stopped"])
-                        return chat_history, None, None
+                        return chat_history, None, None, None
 
                     progress_bar.close()
 
@@ -566,19 +1648,15 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
 
                 if enable_libretranslate:
                     try:
-                        translator = LibreTranslateAPI("http://127.0.0.1:5000")
-                        translation = translator.translate(text, detect_lang, target_lang)
-                        text = translation
-                    except urllib.error.URLError:
+                        text = translate_long_text(text, detect_lang, target_lang)
+                    except requests.exceptions.ConnectionError:
                         chat_history.append([None, "LibreTranslate is not running. Please start the LibreTranslate server."])
                         return chat_history, None, None, None
+                    except requests.exceptions.RequestException as e:
+                        chat_history.append([None, f"LibreTranslate error: {e}"])
+                        return chat_history, None, None, None
 
-            if not chat_dir:
-                now = datetime.now()
-                chat_dir = os.path.join('outputs', f"LLM_{now.strftime('%Y%m%d_%H%M%S')}")
-                os.makedirs(chat_dir)
-                os.makedirs(os.path.join(chat_dir, 'text'))
-                os.makedirs(os.path.join(chat_dir, 'audio'))
+            create_chat_dir()
             chat_history_path = os.path.join(chat_dir, 'text', f'chat_history.{chat_history_format}')
             if chat_history_format == "txt":
                 with open(chat_history_path, "a", encoding="utf-8") as f:
@@ -586,49 +1664,24 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                     if text:
                         f.write(f"AI: {text}\n\n")
             elif chat_history_format == "json":
-                chat_history = []
-                if os.path.exists(chat_history_path):
-                    with open(chat_history_path, "r", encoding="utf-8") as f:
-                        chat_history = json.load(f)
-                chat_history.append(["Human: " + prompt, "AI: " + (text if text else "")])
-                with open(chat_history_path, "w", encoding="utf-8") as f:
-                    json.dump(chat_history, f, ensure_ascii=False, indent=4)
+                append_history_log(f"{chat_history_path}l", ["Human: " + prompt, "AI: " + (text if text else "")])
             if enable_tts and text:
                 if stop_signal:
                     chat_history.append([prompt, text])
                     return chat_history, None, chat_dir, "Generation stopped"
-                enable_text_splitting = False
-                repetition_penalty = 2.0
-                length_penalty = 1.0
-                if enable_text_splitting:
-                    text_parts = text.split(".")
-                    for part in text_parts:
-                        wav = tts_model.tts(text=part.strip(), speaker_wav=f"inputs/audio/voices/{speaker_wav}",
-                                            language=language,
-                                            temperature=tts_temperature, top_p=tts_top_p, top_k=tts_top_k, speed=tts_speed,
-                                            repetition_penalty=repetition_penalty, length_penalty=length_penalty)
-                        now = datetime.now()
-                        audio_filename = f"TTS_{now.strftime('%Y%m%d_%H%M%S')}.{output_format}"
-                        audio_path = os.path.join(chat_dir, 'audio', audio_filename)
-                        if output_format == "mp3":
-                            sf.write(audio_path, wav, 22050, format='mp3')
-                        elif output_format == "ogg":
-                            sf.write(audio_path, wav, 22050, format='ogg')
-                        else:
-                            sf.write(audio_path, wav, 22050)
+                if tts_wavs:
+                    wav = np.concatenate(tts_wavs)
                 else:
-                    wav = tts_model.tts(text=text, speaker_wav=f"inputs/audio/voices/{speaker_wav}", language=language,
-                                        temperature=tts_temperature, top_p=tts_top_p, top_k=tts_top_k, speed=tts_speed,
-                                        repetition_penalty=repetition_penalty, length_penalty=length_penalty)
-                    now = datetime.now()
-                    audio_filename = f"TTS_{now.strftime('%Y%m%d_%H%M%S')}.{output_format}"
-                    audio_path = os.path.join(chat_dir, 'audio', audio_filename)
-                    if output_format == "mp3":
-                        sf.write(audio_path, wav, 22050, format='mp3')
-                    elif output_format == "ogg":
-                        sf.write(audio_path, wav, 22050, format='ogg')
-                    else:
-                        sf.write(audio_path, wav, 22050)
+                    wav = synthesize_tts(tts_model, text, **tts_kwargs)
+                now = datetime.now()
+                audio_filename = f"TTS_{now.strftime('%Y%m%d_%H%M%S')}.{output_format}"
+                audio_path = os.path.join(chat_dir, 'audio', audio_filename)
+                if output_format == "mp3":
+                    sf.write(audio_path, wav, 22050, format='mp3')
+                elif output_format == "ogg":
+                    sf.write(audio_path, wav, 22050, format='ogg')
+                else:
+                    sf.write(audio_path, wav, 22050)
         finally:
             if tokenizer is not None:
                 del tokenizer
@@ -636,21 +1689,23 @@ def generate_text_and_speech(input_text, input_audio, input_image, llm_model_nam
                 del llm_model
             if tts_model is not None:
                 del tts_model
-            if whisper_model is not None:
-                del whisper_model
             torch.cuda.empty_cache()
 
     chat_history.append([prompt, text])
+    if speculative_decoding_info:
+        chat_history.append([None, speculative_decoding_info])
     return chat_history, audio_path, chat_dir, None
 
 
-def generate_tts_stt(text, audio, tts_settings_html, speaker_wav, language, tts_temperature, tts_top_p, tts_top_k, tts_speed, tts_output_format, stt_output_format):
-    global tts_model, whisper_model
+def generate_tts_stt(text, audio, audio_files, tts_settings_html, speaker_wav, language, tts_temperature, tts_top_p, tts_top_k, tts_speed, tts_output_format, stt_output_format):
+    global tts_model, stop_signal
+    stop_signal = False
 
     tts_output = None
     stt_output = None
 
-    if not text and not audio:
+    audio_paths = ([audio] if audio else []) + [audio_file.name for audio_file in audio_files or []]
+    if not text and not audio_paths:
         return None, "Please enter text for TTS or record audio for STT!"
 
     if text:
@@ -662,8 +1717,8 @@ def generate_tts_stt(text, audio, tts_settings_html, speaker_wav, language, tts_
         tts_model = tts_model.to(device)
 
         try:
-            wav = tts_model.tts(text=text, speaker_wav=f"inputs/audio/voices/{speaker_wav}", language=language,
-                                temperature=tts_temperature, top_p=tts_top_p, top_k=tts_top_k, speed=tts_speed)
+            wav = synthesize_tts(tts_model, text, speaker_wav=f"inputs/audio/voices/{speaker_wav}", language=language,
+                                 temperature=tts_temperature, top_p=tts_top_p, top_k=tts_top_k, speed=tts_speed)
         finally:
             del tts_model
             torch.cuda.empty_cache()
@@ -681,17 +1736,14 @@ def generate_tts_stt(text, audio, tts_settings_html, speaker_wav, language, tts_
         else:
             sf.write(tts_output, wav, 22050)
 
-    if audio:
-        if not whisper_model:
-            whisper_model = load_whisper_model()
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        whisper_model = whisper_model.to(device)
-
-        try:
-            stt_output = transcribe_audio(audio)
-        finally:
-            del whisper_model
-            torch.cuda.empty_cache()
+    if audio_paths:
+        transcripts = [(audio_path, transcribe_audio_segments(audio_path)) for audio_path in audio_paths]
+        if len(transcripts) == 1:
+            stt_output = format_transcript(transcripts[0][1])
+            stt_timestamps = format_transcript(transcripts[0][1], with_timestamps=True)
+        else:
+            stt_output = "\n\n".join(f"{os.path.basename(audio_path)}:\n{format_transcript(transcript)}" for audio_path, transcript in transcripts)
+            stt_timestamps = "\n\n".join(f"{os.path.basename(audio_path)}:\n{format_transcript(transcript, with_timestamps=True)}" for audio_path, transcript in transcripts)
 
         if stt_output:
             today = datetime.now().date()
@@ -702,69 +1754,99 @@ def generate_tts_stt(text, audio, tts_settings_html, speaker_wav, language, tts_
                 stt_filename = f"stt_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
                 stt_file_path = os.path.join(stt_dir, stt_filename)
                 with open(stt_file_path, 'w', encoding='utf-8') as f:
-                    f.write(stt_output)
+                    f.write(stt_timestamps)
             elif stt_output_format == "json":
-                stt_filename = f"stt_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-                stt_file_path = os.path.join(stt_dir, stt_filename)
-                stt_history = []
-                if os.path.exists(stt_file_path):
-                    with open(stt_file_path, "r", encoding="utf-8") as f:
-                        stt_history = json.load(f)
-                stt_history.append(stt_output)
-                with open(stt_file_path, "w", encoding="utf-8") as f:
-                    json.dump(stt_history, f, ensure_ascii=False, indent=4)
+                append_history_log(os.path.join(stt_dir, "stt_history.jsonl"), stt_output)
 
     return tts_output, stt_output
 
 
-def generate_bark_audio(text, voice_preset, max_length, fine_temperature, coarse_temperature, output_format, stop_generation):
+def get_bark_model():
+    global bark_processor, bark_model
+    if bark_model is None:
+        bark_model_path = os.path.join("inputs", "audio", "bark")
+
+        if not os.path.exists(bark_model_path):
+            print("Downloading Bark model...")
+            os.makedirs(bark_model_path, exist_ok=True)
+            Repo.clone_from("https://huggingface.co/suno/bark", bark_model_path)
+            print("Bark model downloaded")
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        bark_processor = AutoProcessor.from_pretrained(bark_model_path)
+        bark_model = BarkModel.from_pretrained(bark_model_path, torch_dtype=torch.float32).to(device)
+    return bark_processor, bark_model
+
+
+def crossfade_concat(chunks, sample_rate, crossfade_ms=50):
+    fade_length = int(sample_rate * crossfade_ms / 1000)
+    audio = chunks[0]
+    for chunk in chunks[1:]:
+        overlap = min(fade_length, len(audio), len(chunk))
+        if overlap == 0:
+            audio = np.concatenate([audio, chunk])
+            continue
+        fade_in = np.linspace(0.0, 1.0, overlap, dtype=audio.dtype)
+        mixed = audio[-overlap:] * (1.0 - fade_in) + chunk[:overlap] * fade_in
+        audio = np.concatenate([audio[:-overlap], mixed, chunk[overlap:]])
+    return audio
+
+
+def generate_bark_audio(text, voice_preset, max_length, fine_temperature, coarse_temperature, output_format, stop_generation, batch_size=16):
     global stop_signal
     stop_signal = False
 
     if not text:
         return None, "Please enter text for the request!"
 
-    bark_model_path = os.path.join("inputs", "audio", "bark")
+    try:
+        processor, model = get_bark_model()
+        device = model.device
 
-    if not os.path.exists(bark_model_path):
-        print("Downloading Bark model...")
-        os.makedirs(bark_model_path, exist_ok=True)
-        Repo.clone_from("https://huggingface.co/suno/bark", bark_model_path)
-        print("Bark model downloaded")
+        sentences, remainder = split_sentences(text.strip())
+        if remainder.strip():
+            sentences.append(remainder)
 
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        torch.set_default_tensor_type(torch.cuda.FloatTensor if device == "cuda" else torch.FloatTensor)
+        audio_chunks = []
+        for i in range(0, len(sentences), batch_size):
+            if stop_signal:
+                return None, "Generation stopped"
 
-        processor = AutoProcessor.from_pretrained(bark_model_path)
-        model = BarkModel.from_pretrained(bark_model_path, torch_dtype=torch.float32)
+            if voice_preset:
+                inputs = processor(sentences[i:i + batch_size], voice_preset=voice_preset, return_tensors="pt")
+            else:
+                inputs = processor(sentences[i:i + batch_size], return_tensors="pt")
+            inputs = {key: value.to(device) if torch.is_tensor(value) else value for key, value in inputs.items()}
+            if inputs.get("history_prompt") is not None:
+                inputs["history_prompt"] = {key: value.to(device) for key, value in inputs["history_prompt"].items()}
 
-        if voice_preset:
-            inputs = processor(text, voice_preset=voice_preset, return_tensors="pt")
-        else:
-            inputs = processor(text, return_tensors="pt")
+            with torch.no_grad():
+                audio_array, output_lengths = model.generate(**inputs, max_length=max_length, do_sample=True, fine_temperature=fine_temperature,
+                                                             coarse_temperature=coarse_temperature, return_output_lengths=True)
 
-        audio_array = model.generate(**inputs, max_length=max_length, do_sample=True, fine_temperature=fine_temperature, coarse_temperature=coarse_temperature)
-        model.enable_cpu_offload()
+            audio_array = audio_array.cpu().numpy()
+            for audio, output_length in zip(audio_array, output_lengths):
+                audio_chunks.append(audio[:int(output_length)])
 
         if stop_signal:
             return None, "Generation stopped"
 
+        sample_rate = model.generation_config.sample_rate
+        audio_array = crossfade_concat(audio_chunks, sample_rate)
+
         today = datetime.now().date()
         audio_dir = os.path.join('outputs', f"Bark_{today.strftime('%Y%m%d')}")
         os.makedirs(audio_dir, exist_ok=True)
 
-        audio_array = audio_array.cpu().numpy().squeeze()
-
         audio_filename = f"bark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
         audio_path = os.path.join(audio_dir, audio_filename)
 
         if output_format == "mp3":
-            sf.write(audio_path, audio_array, 24000)
+            sf.write(audio_path, audio_array, sample_rate)
         elif output_format == "ogg":
-            sf.write(audio_path, audio_array, 24000)
+            sf.write(audio_path, audio_array, sample_rate)
         else:
-            sf.write(audio_path, audio_array, 24000)
+            sf.write(audio_path, audio_array, sample_rate)
 
         return audio_path, None
 
@@ -772,18 +1854,15 @@ def generate_bark_audio(text, voice_preset, max_length, fine_temperature, coarse
         return None, str(e)
 
     finally:
-        del model
-        del processor
         torch.cuda.empty_cache()
 
 
 def translate_text(text, source_lang, target_lang, enable_translate_history, translate_history_format, file=None):
     try:
-        translator = LibreTranslateAPI("http://127.0.0.1:5000")
         if file:
             with open(file.name, "r", encoding="utf-8") as f:
                 text = f.read()
-        translation = translator.translate(text, source_lang, target_lang)
+        translation = translate_long_text(text, source_lang, target_lang)
 
         if enable_translate_history:
             today = datetime.now().date()
@@ -796,11 +1875,7 @@ def translate_text(text, source_lang, target_lang, enable_translate_history, tra
                     f.write(f"Source ({source_lang}): {text}\n")
                     f.write(f"Translation ({target_lang}): {translation}\n\n")
             elif translate_history_format == "json":
-                translate_history = []
-                if os.path.exists(translate_history_path):
-                    with open(translate_history_path, "r", encoding="utf-8") as f:
-                        translate_history = json.load(f)
-                translate_history.append({
+                append_history_log(f"{translate_history_path}l", {
                     "source": {
                         "language": source_lang,
                         "text": text
@@ -810,15 +1885,16 @@ def translate_text(text, source_lang, target_lang, enable_translate_history, tra
                         "text": translation
                     }
                 })
-                with open(translate_history_path, "w", encoding="utf-8") as f:
-                    json.dump(translate_history, f, ensure_ascii=False, indent=4)
 
         return translation
 
-    except urllib.error.URLError as e:
+    except requests.exceptions.ConnectionError:
         error_message = "LibreTranslate is not running. Please start the LibreTranslate server."
         return error_message
 
+    except requests.exceptions.RequestException as e:
+        return f"LibreTranslate error: {e}"
+
 
 def generate_wav2lip(image_path, audio_path, fps, pads, face_det_batch_size, wav2lip_batch_size, resize_factor, crop):
     global stop_signal
@@ -848,7 +1924,7 @@ def generate_wav2lip(image_path, audio_path, fps, pads, face_det_batch_size, wav
         output_filename = f"face_animation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
         output_path = os.path.join(output_dir, output_filename)
 
-        command = f"py {os.path.join(wav2lip_path, 'inference.py')} --checkpoint_path {checkpoint_path} --face {image_path} --audio {audio_path} --outfile {output_path} --fps {fps} --pads {pads} --face_det_batch_size {face_det_batch_size} --wav2lip_batch_size {wav2lip_batch_size} --resize_factor {resize_factor} --crop {crop} --box {-1}"
+        command = f"py {os.path.join(wav2lip_path, 'inference.py')} --checkpoint_path {checkpoint_path} --face {image_path} --audio {get_cached_wav_path(audio_path)} --outfile {output_path} --fps {fps} --pads {pads} --face_det_batch_size {face_det_batch_size} --wav2lip_batch_size {wav2lip_batch_size} --resize_factor {resize_factor} --crop {crop} --box {-1}"
 
         subprocess.run(command, shell=True, check=True)
 
@@ -864,7 +1940,10 @@ def generate_wav2lip(image_path, audio_path, fps, pads, face_det_batch_size, wav
 def generate_image_txt2img(prompt, negative_prompt, stable_diffusion_model_name, vae_model_name, lora_model_names, textual_inversion_model_names, stable_diffusion_settings_html,
                            stable_diffusion_model_type, stable_diffusion_sampler, stable_diffusion_steps,
                            stable_diffusion_cfg, stable_diffusion_width, stable_diffusion_height,
-                           stable_diffusion_clip_skip, enable_freeu=False, enable_tiled_vae=False, enable_upscale=False, upscale_factor="x2", upscale_steps=50, upscale_cfg=6, output_format="png", stop_generation=None):
+                           stable_diffusion_clip_skip, enable_freeu=False, enable_tiled_vae=False,
+                           enable_tiled_diffusion=False, tile_size=768, tile_overlap=128, enable_upscale=False, upscale_factor="x2", upscale_steps=50, upscale_cfg=6,
+                           snapshot_steps="", vary_latents_file=None, vary_from_step=0, variation_seed=-1,
+                           enable_turbo=False, turbo_steps=1, output_format="png", stop_generation=None):
     global stop_signal
     stop_signal = False
 
@@ -896,7 +1975,7 @@ def generate_image_txt2img(prompt, negative_prompt, stable_diffusion_model_name,
             original_config_file = "configs/sd/sd_xl_base.yaml"
             vae_config_file = "configs/sd/sd_xl_base.yaml"
             stable_diffusion_model = StableDiffusionXLPipeline.from_single_file(
-                stable_diffusion_model_path, use_safetensors=True, device_map="auto", attention_slice=1,
+                stable_diffusion_model_path, use_safetensors=True, device_map="auto",
                 original_config_file=original_config_file, torch_dtype=torch.float16, variant="fp16"
             )
         else:
@@ -921,9 +2000,6 @@ def generate_image_txt2img(prompt, negative_prompt, stable_diffusion_model_name,
     if enable_freeu:
         stable_diffusion_model.enable_freeu(s1=0.9, s2=0.2, b1=1.2, b2=1.4)
 
-    if enable_tiled_vae:
-        stable_diffusion_model.enable_vae_tiling()
-
     if vae_model_name is not None:
         vae_model_path = os.path.join("inputs", "image", "sd_models", "vae", f"{vae_model_name}.safetensors")
         if os.path.exists(vae_model_path):
@@ -944,8 +2020,110 @@ def generate_image_txt2img(prompt, negative_prompt, stable_diffusion_model_name,
             if os.path.exists(textual_inversion_model_path):
                 stable_diffusion_model.load_textual_inversion(textual_inversion_model_path)
 
+    turbo_message = None
+    if enable_turbo:
+        # Distilled few-step sampling as in scripts/demo/turbo.py: trailing Euler ancestral (or LCM) steps, no CFG pass
+        turbo_compatibility, turbo_message = detect_turbo_compatibility(stable_diffusion_model_name,
+                                                                        stable_diffusion_model_type, lora_model_names)
+        if turbo_compatibility == "turbo":
+            stable_diffusion_model.scheduler = EulerAncestralDiscreteScheduler.from_config(
+                stable_diffusion_model.scheduler.config, timestep_spacing="trailing")
+        elif turbo_compatibility is not None:
+            if turbo_compatibility == "lcm-lora":
+                stable_diffusion_model.load_lora_weights(load_lcm_lora_model(stable_diffusion_model_type))
+            stable_diffusion_model.scheduler = LCMScheduler.from_config(stable_diffusion_model.scheduler.config)
+        if turbo_compatibility is not None:
+            stable_diffusion_steps = int(turbo_steps)
+            stable_diffusion_cfg = 0.0
+            turbo_message = f"{turbo_message}, {stable_diffusion_steps} step(s) without CFG"
+
+    if enable_tiled_diffusion:
+        memory_plan = plan_memory(stable_diffusion_model, f"txt2img-{stable_diffusion_model_type}-tiled",
+                                  int(tile_size), int(tile_size), batch_size=tiled_diffusion_batch_size,
+                                  guidance=stable_diffusion_cfg > 1)
+    else:
+        memory_plan = plan_memory(stable_diffusion_model, f"txt2img-{stable_diffusion_model_type}",
+                                  stable_diffusion_width, stable_diffusion_height, guidance=stable_diffusion_cfg > 1,
+                                  force=("vae_tiling",) if enable_tiled_vae else ())
+
     try:
-        if stable_diffusion_model_type == "SDXL":
+        snapshot_step_list = sorted({int(step) for step in str(snapshot_steps or "").replace(" ", "").split(",")
+                                     if step.isdigit() and 0 < int(step) < stable_diffusion_steps})
+        take_snapshots = bool(snapshot_step_list) and not enable_tiled_diffusion and not vary_latents_file and not enable_turbo
+        latent_snapshots = {}
+        snapshot_embeds = {}
+        snapshot_kwargs = {}
+        snapshot_scheduler_message = ""
+        if take_snapshots:
+            # Snapshots are only resumable with the scheduler the variations are sampled with
+            if not isinstance(stable_diffusion_model.scheduler, EulerAncestralDiscreteScheduler):
+                snapshot_scheduler_message = (f" (sampled with EulerAncestralDiscreteScheduler instead of "
+                                              f"{type(stable_diffusion_model.scheduler).__name__}, so that the "
+                                              f"snapshots can be resumed)")
+                stable_diffusion_model.scheduler = EulerAncestralDiscreteScheduler.from_config(
+                    stable_diffusion_model.scheduler.config)
+
+            def store_latent_snapshot(pipe, i, t, callback_kwargs):
+                if i + 1 in snapshot_step_list:
+                    latent_snapshots[i + 1] = callback_kwargs["latents"].detach().cpu()
+                return callback_kwargs
+
+            snapshot_kwargs = {"callback_on_step_end": store_latent_snapshot,
+                               "callback_on_step_end_tensor_inputs": ["latents"]}
+
+        if vary_latents_file:
+            snapshot = torch.load(vary_latents_file, map_location="cpu")
+            vary_step = int(vary_from_step)
+            if snapshot["model"] != stable_diffusion_model_name or snapshot["model_type"] != stable_diffusion_model_type:
+                return None, "The latent snapshot was made with a different StableDiffusion model!"
+            if vary_step not in snapshot["latents"]:
+                return None, f"No latent snapshot for step {vary_step}, available steps: {sorted(snapshot['latents'])}"
+
+            seed = int(variation_seed)
+            if seed < 0:
+                seed = random.randint(0, 2 ** 32 - 1)
+
+            stable_diffusion_model.scheduler = EulerAncestralDiscreteScheduler.from_config(
+                stable_diffusion_model.scheduler.config)
+            embeds = {name: value.to(device) if value is not None else None for name, value in snapshot["embeds"].items()}
+            image = generate_tiled_diffusion_image(stable_diffusion_model, embeds["prompt_embeds"],
+                                                   embeds["negative_prompt_embeds"], snapshot["steps"], snapshot["cfg"],
+                                                   snapshot["width"], snapshot["height"],
+                                                   tile_size=max(snapshot["width"], snapshot["height"]), tile_overlap=0,
+                                                   pooled_prompt_embeds=embeds["pooled_prompt_embeds"],
+                                                   negative_pooled_prompt_embeds=embeds["negative_pooled_prompt_embeds"],
+                                                   latents=snapshot["latents"][vary_step], start_step=vary_step,
+                                                   generator=torch.Generator(device).manual_seed(seed))
+            if image is None:
+                return None, "Generation stopped"
+            images = {"images": [image]}
+        elif enable_tiled_diffusion:
+            if stable_diffusion_model_type == "SDXL":
+                compel = Compel(
+                    tokenizer=[stable_diffusion_model.tokenizer, stable_diffusion_model.tokenizer_2],
+                    text_encoder=[stable_diffusion_model.text_encoder, stable_diffusion_model.text_encoder_2],
+                    returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED,
+                    requires_pooled=[False, True]
+                )
+                prompt_embeds, pooled_prompt_embeds = compel(prompt)
+                negative_prompt_embeds, negative_pooled_prompt_embeds = compel(negative_prompt)
+            else:
+                compel_proc = Compel(tokenizer=stable_diffusion_model.tokenizer,
+                                     text_encoder=stable_diffusion_model.text_encoder)
+                prompt_embeds = compel_proc(prompt)
+                negative_prompt_embeds = compel_proc(negative_prompt)
+                pooled_prompt_embeds = negative_pooled_prompt_embeds = None
+
+            image = generate_tiled_diffusion_image(stable_diffusion_model, prompt_embeds, negative_prompt_embeds,
+                                                   stable_diffusion_steps, stable_diffusion_cfg, int(stable_diffusion_width),
+                                                   int(stable_diffusion_height),
+                                                   tile_size=int(tile_size), tile_overlap=int(tile_overlap),
+                                                   pooled_prompt_embeds=pooled_prompt_embeds,
+                                                   negative_pooled_prompt_embeds=negative_pooled_prompt_embeds)
+            if image is None:
+                return None, "Generation stopped"
+            images = {"images": [image]}
+        elif stable_diffusion_model_type == "SDXL":
             compel = Compel(
                 tokenizer=[stable_diffusion_model.tokenizer, stable_diffusion_model.tokenizer_2],
                 text_encoder=[stable_diffusion_model.text_encoder, stable_diffusion_model.text_encoder_2],
@@ -953,37 +2131,74 @@ def generate_image_txt2img(prompt, negative_prompt, stable_diffusion_model_name,
                 requires_pooled=[False, True]
             )
             prompt_embeds, pooled_prompt_embeds = compel(prompt)
+            if take_snapshots:
+                negative_prompt_embeds, negative_pooled_prompt_embeds = compel(negative_prompt)
+                snapshot_embeds = {"prompt_embeds": prompt_embeds, "negative_prompt_embeds": negative_prompt_embeds,
+                                   "pooled_prompt_embeds": pooled_prompt_embeds,
+                                   "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds}
+                negative_kwargs = {"negative_prompt_embeds": negative_prompt_embeds,
+                                   "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds}
+            else:
+                negative_kwargs = {"negative_prompt": negative_prompt}
             images = stable_diffusion_model(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds,
-                                            negative_prompt=negative_prompt,
                                             num_inference_steps=stable_diffusion_steps,
                                             guidance_scale=stable_diffusion_cfg, height=stable_diffusion_height,
                                             width=stable_diffusion_width, clip_skip=stable_diffusion_clip_skip,
-                                            sampler=stable_diffusion_sampler)
+                                            sampler=stable_diffusion_sampler, **negative_kwargs, **snapshot_kwargs)
         else:
             compel_proc = Compel(tokenizer=stable_diffusion_model.tokenizer,
                                  text_encoder=stable_diffusion_model.text_encoder)
             prompt_embeds = compel_proc(prompt)
             negative_prompt_embeds = compel_proc(negative_prompt)
+            if take_snapshots:
+                snapshot_embeds = {"prompt_embeds": prompt_embeds, "negative_prompt_embeds": negative_prompt_embeds,
+                                   "pooled_prompt_embeds": None, "negative_pooled_prompt_embeds": None}
 
+            # SD/SD2 latents are fed straight into the x2 latent upscaler and decoded only once at the end
+            chain_latents = enable_upscale and upscale_factor == "x2"
             images = stable_diffusion_model(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_prompt_embeds,
                                             num_inference_steps=stable_diffusion_steps,
                                             guidance_scale=stable_diffusion_cfg, height=stable_diffusion_height,
                                             width=stable_diffusion_width, clip_skip=stable_diffusion_clip_skip,
-                                            sampler=stable_diffusion_sampler)
-
+                                            sampler=stable_diffusion_sampler,
+                                            output_type="latent" if chain_latents else "pil", **snapshot_kwargs)
+
+            if chain_latents and not stop_signal:
+                record_memory_peak(memory_plan)
+                upscaler, error_message = load_upscale_model(2)
+                if upscaler is None:
+                    return None, error_message
+                memory_plan = plan_memory(upscaler, "upscale-x2", int(stable_diffusion_width) * 2,
+                                          int(stable_diffusion_height) * 2, guidance=upscale_cfg > 1)
+                upscaled_latents = upscaler(prompt=prompt, negative_prompt=negative_prompt or None,
+                                            image=images["images"], num_inference_steps=upscale_steps,
+                                            guidance_scale=upscale_cfg, output_type="latent").images
+                with torch.no_grad():
+                    decoded = stable_diffusion_model.vae.decode(
+                        upscaled_latents.to(stable_diffusion_model.vae.dtype) / stable_diffusion_model.vae.config.scaling_factor,
+                        return_dict=False
+                    )[0]
+                images = {"images": stable_diffusion_model.image_processor.postprocess(decoded, output_type="pil")}
+                enable_upscale = False
+
+        record_memory_peak(memory_plan)
         if stop_signal:
             return None, "Generation stopped"
         image = images["images"][0]
 
         if enable_upscale:
             upscale_factor_value = 2 if upscale_factor == "x2" else 4
-            upscaler = load_upscale_model(upscale_factor_value)
-            if upscaler:
-                if upscale_factor == "x2":
-                    upscaled_image = upscaler(prompt=prompt, image=image, num_inference_steps=upscale_steps, guidance_scale=upscale_cfg).images[0]
-                else:
-                    upscaled_image = upscaler(prompt=prompt, image=image, num_inference_steps=upscale_steps, guidance_scale=upscale_cfg)["images"][0]
-                image = upscaled_image
+            upscaler, error_message = load_upscale_model(upscale_factor_value)
+            if upscaler is None:
+                return None, error_message
+            memory_plan = plan_memory(upscaler, f"upscale-x{upscale_factor_value}", image.width * upscale_factor_value,
+                                      image.height * upscale_factor_value, guidance=upscale_cfg > 1)
+            if upscale_factor == "x2":
+                upscaled_image = upscaler(prompt=prompt, image=image, num_inference_steps=upscale_steps, guidance_scale=upscale_cfg).images[0]
+            else:
+                upscaled_image = upscaler(prompt=prompt, image=image, num_inference_steps=upscale_steps, guidance_scale=upscale_cfg)["images"][0]
+            record_memory_peak(memory_plan)
+            image = upscaled_image
 
         today = datetime.now().date()
         image_dir = os.path.join('outputs', f"StableDiffusion_{today.strftime('%Y%m%d')}")
@@ -992,7 +2207,23 @@ def generate_image_txt2img(prompt, negative_prompt, stable_diffusion_model_name,
         image_path = os.path.join(image_dir, image_filename)
         image.save(image_path, format=output_format.upper())
 
-        return image_path, None
+        if latent_snapshots:
+            snapshot_path = f"{os.path.splitext(image_path)[0]}_latents.pt"
+            torch.save({
+                "model": stable_diffusion_model_name,
+                "model_type": stable_diffusion_model_type,
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "steps": stable_diffusion_steps,
+                "cfg": stable_diffusion_cfg,
+                "width": int(stable_diffusion_width),
+                "height": int(stable_diffusion_height),
+                "embeds": {name: value.cpu() if value is not None else None for name, value in snapshot_embeds.items()},
+                "latents": latent_snapshots,
+            }, snapshot_path)
+            return image_path, f"Latent snapshots saved to {snapshot_path}{snapshot_scheduler_message}"
+
+        return image_path, turbo_message
 
     finally:
         del stable_diffusion_model
@@ -1003,7 +2234,8 @@ def generate_image_img2img(prompt, negative_prompt, init_image,
                            strength, stable_diffusion_model_name, vae_model_name, stable_diffusion_settings_html,
                            stable_diffusion_model_type,
                            stable_diffusion_sampler, stable_diffusion_steps, stable_diffusion_cfg,
-                           stable_diffusion_clip_skip, output_format="png", stop_generation=None):
+                           stable_diffusion_clip_skip, enable_tiled_diffusion=False, tile_size=768, tile_overlap=128,
+                           output_format="png", stop_generation=None):
     global stop_signal
     stop_signal = False
 
@@ -1038,7 +2270,7 @@ def generate_image_img2img(prompt, negative_prompt, init_image,
             original_config_file = "configs/sd/sd_xl_base.yaml"
             vae_config_file = "configs/sd/sd_xl_base.yaml"
             stable_diffusion_model = StableDiffusionImg2ImgPipeline.from_single_file(
-                stable_diffusion_model_path, use_safetensors=True, device_map="auto", attention_slice=1,
+                stable_diffusion_model_path, use_safetensors=True, device_map="auto",
                 original_config_file=original_config_file, torch_dtype=torch.float16, variant="fp16"
             )
         else:
@@ -1068,11 +2300,47 @@ def generate_image_img2img(prompt, negative_prompt, init_image,
                                                  variant="fp16")
             stable_diffusion_model.vae = vae.to(device)
 
+    enable_vae_encode_cache(stable_diffusion_model, (stable_diffusion_model_path, vae_model_name))
+
     try:
         init_image = Image.open(init_image).convert("RGB")
         init_image = stable_diffusion_model.image_processor.preprocess(init_image)
 
-        if stable_diffusion_model_type == "SDXL":
+        if enable_tiled_diffusion:
+            memory_plan = plan_memory(stable_diffusion_model, f"img2img-{stable_diffusion_model_type}-tiled",
+                                      int(tile_size), int(tile_size), batch_size=tiled_diffusion_batch_size,
+                                      guidance=stable_diffusion_cfg > 1)
+        else:
+            memory_plan = plan_memory(stable_diffusion_model, f"img2img-{stable_diffusion_model_type}",
+                                      init_image.shape[-1], init_image.shape[-2], guidance=stable_diffusion_cfg > 1)
+
+        if enable_tiled_diffusion:
+            if stable_diffusion_model_type == "SDXL":
+                compel = Compel(
+                    tokenizer=[stable_diffusion_model.tokenizer, stable_diffusion_model.tokenizer_2],
+                    text_encoder=[stable_diffusion_model.text_encoder, stable_diffusion_model.text_encoder_2],
+                    returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED,
+                    requires_pooled=[False, True]
+                )
+                prompt_embeds, pooled_prompt_embeds = compel(prompt)
+                negative_prompt_embeds, negative_pooled_prompt_embeds = compel(negative_prompt)
+            else:
+                compel_proc = Compel(tokenizer=stable_diffusion_model.tokenizer,
+                                     text_encoder=stable_diffusion_model.text_encoder)
+                prompt_embeds = compel_proc(prompt)
+                negative_prompt_embeds = compel_proc(negative_prompt)
+                pooled_prompt_embeds = negative_pooled_prompt_embeds = None
+
+            image = generate_tiled_diffusion_image(stable_diffusion_model, prompt_embeds, negative_prompt_embeds,
+                                                   stable_diffusion_steps, stable_diffusion_cfg, None, None,
+                                                   tile_size=int(tile_size), tile_overlap=int(tile_overlap),
+                                                   init_image=init_image, strength=strength,
+                                                   pooled_prompt_embeds=pooled_prompt_embeds,
+                                                   negative_pooled_prompt_embeds=negative_pooled_prompt_embeds)
+            if image is None:
+                return None, "Generation stopped"
+            images = {"images": [image]}
+        elif stable_diffusion_model_type == "SDXL":
             compel = Compel(
                 tokenizer=[stable_diffusion_model.tokenizer, stable_diffusion_model.tokenizer_2],
                 text_encoder=[stable_diffusion_model.text_encoder, stable_diffusion_model.text_encoder_2],
@@ -1096,6 +2364,7 @@ def generate_image_img2img(prompt, negative_prompt, init_image,
                                             guidance_scale=stable_diffusion_cfg, clip_skip=stable_diffusion_clip_skip,
                                             sampler=stable_diffusion_sampler, image=init_image, strength=strength)
 
+        record_memory_peak(memory_plan)
         if stop_signal:
             return None, "Generation stopped"
         image = images["images"][0]
@@ -1156,6 +2425,8 @@ def generate_image_depth2img(prompt, negative_prompt, init_image, stable_diffusi
 
     stable_diffusion_model.safety_checker = None
 
+    enable_vae_encode_cache(stable_diffusion_model, stable_diffusion_model_path)
+
     try:
         init_image = Image.open(init_image).convert("RGB")
 
@@ -1204,6 +2475,7 @@ def generate_image_pix2pix(prompt, negative_prompt, init_image, num_inference_st
         pipe = StableDiffusionInstructPix2PixPipeline.from_pretrained(pix2pix_model_path, torch_dtype=torch.float16,
                                                                       safety_checker=None)
         pipe.to(device)
+        enable_vae_encode_cache(pipe, pix2pix_model_path)
 
         image = Image.open(init_image).convert("RGB")
 
@@ -1357,8 +2629,8 @@ def generate_image_controlnet(prompt, negative_prompt, init_image, stable_diffus
                 device_map="auto",
                 use_safetensors=True,
             )
-            pipe.enable_model_cpu_offload()
-            pipe.to(device)
+            memory_plan = plan_memory(pipe, f"controlnet-{controlnet_model_name}", width, height,
+                                      guidance=guidance_scale > 1)
 
             image = Image.open(init_image).convert("RGB")
 
@@ -1397,6 +2669,7 @@ def generate_image_controlnet(prompt, negative_prompt, init_image, stable_diffus
             image = pipe(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_prompt_embeds,
                          num_inference_steps=num_inference_steps, guidance_scale=guidance_scale, width=width,
                          height=height, generator=generator, image=control_image).images[0]
+            record_memory_peak(memory_plan)
 
         if stop_signal:
             return None, "Generation stopped"
@@ -1431,27 +2704,29 @@ def generate_image_upscale_latent(image_path, num_inference_steps, guidance_scal
         return None, "Please, upload an initial image!"
 
     upscale_factor = 2
-    upscaler = load_upscale_model(upscale_factor)
+    upscaler, error_message = load_upscale_model(upscale_factor)
+    if upscaler is None:
+        return None, error_message
 
-    if upscaler:
-        try:
-            image = Image.open(image_path).convert("RGB")
-            upscaled_image = upscaler(prompt="", image=image, num_inference_steps=num_inference_steps, guidance_scale=guidance_scale).images[0]
+    # The upscaler stays resident in upscale_models, only the activations are released afterwards
+    try:
+        image = Image.open(image_path).convert("RGB")
+        memory_plan = plan_memory(upscaler, "upscale-x2", image.width * 2, image.height * 2,
+                                  guidance=guidance_scale > 1)
+        upscaled_image = upscaler(prompt="", image=image, num_inference_steps=num_inference_steps, guidance_scale=guidance_scale).images[0]
+        record_memory_peak(memory_plan)
 
-            today = datetime.now().date()
-            image_dir = os.path.join('outputs', f"StableDiffusion_{today.strftime('%Y%m%d')}")
-            os.makedirs(image_dir, exist_ok=True)
-            image_filename = f"upscaled_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
-            image_path = os.path.join(image_dir, image_filename)
-            upscaled_image.save(image_path, format=output_format.upper())
+        today = datetime.now().date()
+        image_dir = os.path.join('outputs', f"StableDiffusion_{today.strftime('%Y%m%d')}")
+        os.makedirs(image_dir, exist_ok=True)
+        image_filename = f"upscaled_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
+        image_path = os.path.join(image_dir, image_filename)
+        upscaled_image.save(image_path, format=output_format.upper())
 
-            return image_path, None
+        return image_path, None
 
-        finally:
-            del upscaler
-            torch.cuda.empty_cache()
-    else:
-        return None, "Failed to load upscale model"
+    finally:
+        torch.cuda.empty_cache()
 
 
 def generate_image_upscale_realesrgan(image_path, outscale, output_format="png", stop_generation=None):
@@ -1491,7 +2766,8 @@ def generate_image_upscale_realesrgan(image_path, outscale, output_format="png",
         return None, str(e)
 
 
-def generate_image_inpaint(prompt, negative_prompt, init_image, mask_image, blur_factor, stable_diffusion_model_name, vae_model_name,
+def generate_image_inpaint(prompt, negative_prompt, init_image, mask_image, blur_factor, inpaint_masked_only, masked_padding,
+                           stable_diffusion_model_name, vae_model_name,
                            stable_diffusion_settings_html, stable_diffusion_model_type, stable_diffusion_sampler,
                            stable_diffusion_steps, stable_diffusion_cfg, width, height, output_format="png", stop_generation=None):
     global stop_signal
@@ -1528,7 +2804,7 @@ def generate_image_inpaint(prompt, negative_prompt, init_image, mask_image, blur
             original_config_file = "configs/sd/sd_xl_base.yaml"
             vae_config_file = "configs/sd/sd_xl_base.yaml"
             stable_diffusion_model = StableDiffusionInpaintPipeline.from_single_file(
-                stable_diffusion_model_path, use_safetensors=True, device_map="auto", attention_slice=1,
+                stable_diffusion_model_path, use_safetensors=True, device_map="auto",
                 original_config_file=original_config_file, torch_dtype=torch.float16, variant="fp16"
             )
         else:
@@ -1558,6 +2834,8 @@ def generate_image_inpaint(prompt, negative_prompt, init_image, mask_image, blur
                                                  variant="fp16")
             stable_diffusion_model.vae = vae.to(device)
 
+    enable_vae_encode_cache(stable_diffusion_model, (stable_diffusion_model_path, vae_model_name))
+
     try:
         if isinstance(mask_image, dict):
             composite_path = mask_image.get('composite', None)
@@ -1582,6 +2860,20 @@ def generate_image_inpaint(prompt, negative_prompt, init_image, mask_image, blur
         else:
             blurred_mask = mask_array
 
+        full_image = init_image
+        full_mask = blurred_mask
+        crop_region = None
+        if inpaint_masked_only and mask_array.getbbox() is not None:
+            # Only a padded box around the mask is inpainted at the model's resolution and blended back afterwards
+            width, height = int(width), int(height)
+            crop_region = stable_diffusion_model.mask_processor.get_crop_region(mask_array, width, height,
+                                                                               pad=int(masked_padding))
+            init_image = full_image.crop(crop_region).resize((width, height), resample=Image.LANCZOS)
+            blurred_mask = full_mask.crop(crop_region).resize((width, height), resample=Image.LANCZOS)
+
+        memory_plan = plan_memory(stable_diffusion_model, f"inpaint-{stable_diffusion_model_type}", width, height,
+                                  guidance=stable_diffusion_cfg > 1)
+
         if stable_diffusion_model_type == "SDXL":
             compel = Compel(
                 tokenizer=[stable_diffusion_model.tokenizer, stable_diffusion_model.tokenizer_2],
@@ -1608,10 +2900,17 @@ def generate_image_inpaint(prompt, negative_prompt, init_image, mask_image, blur
                                             num_inference_steps=stable_diffusion_steps,
                                             guidance_scale=stable_diffusion_cfg, sampler=stable_diffusion_sampler)
 
+        record_memory_peak(memory_plan)
         if stop_signal:
             return None, "Generation stopped"
         image = images["images"][0]
 
+        if crop_region is not None:
+            crop_size = (crop_region[2] - crop_region[0], crop_region[3] - crop_region[1])
+            inpainted_crop = image.resize(crop_size, resample=Image.LANCZOS)
+            image = full_image.copy()
+            image.paste(inpainted_crop, crop_region[:2], mask=full_mask.crop(crop_region).convert("L"))
+
         today = datetime.now().date()
         image_dir = os.path.join('outputs', f"StableDiffusion_{today.strftime('%Y%m%d')}")
         os.makedirs(image_dir, exist_ok=True)
@@ -1658,7 +2957,7 @@ def generate_image_gligen(prompt, negative_prompt, gligen_phrases, gligen_boxes,
         elif stable_diffusion_model_type == "SDXL":
             original_config_file = "configs/sd/sd_xl_base.yaml"
             stable_diffusion_model = StableDiffusionXLPipeline.from_single_file(
-                stable_diffusion_model_path, use_safetensors=True, device_map="auto", attention_slice=1,
+                stable_diffusion_model_path, use_safetensors=True, device_map="auto",
                 original_config_file=original_config_file, torch_dtype=torch.float16, variant="fp16"
             )
         else:
@@ -1681,6 +2980,9 @@ def generate_image_gligen(prompt, negative_prompt, gligen_phrases, gligen_boxes,
     stable_diffusion_model.safety_checker = None
 
     try:
+        memory_plan = plan_memory(stable_diffusion_model, f"gligen-{stable_diffusion_model_type}",
+                                  stable_diffusion_width, stable_diffusion_height, guidance=stable_diffusion_cfg > 1)
+
         if stable_diffusion_model_type == "SDXL":
             compel = Compel(
                 tokenizer=[stable_diffusion_model.tokenizer, stable_diffusion_model.tokenizer_2],
@@ -1707,6 +3009,7 @@ def generate_image_gligen(prompt, negative_prompt, gligen_phrases, gligen_boxes,
                                            width=stable_diffusion_width, clip_skip=stable_diffusion_clip_skip,
                                            sampler=stable_diffusion_sampler)["images"][0]
 
+        record_memory_peak(memory_plan)
         if stop_signal:
             return None, "Generation stopped"
 
@@ -1801,8 +3104,8 @@ def generate_image_animatediff(prompt, negative_prompt, input_video, strength, s
                 scheduler=stable_diffusion_model.scheduler,
             )
 
-            pipe.enable_vae_slicing()
-            pipe.enable_model_cpu_offload()
+            memory_plan = plan_memory(pipe, "animatediff", width, height, num_frames=int(num_frames),
+                                      guidance=guidance_scale > 1)
 
             compel_proc = Compel(tokenizer=stable_diffusion_model.tokenizer,
                                  text_encoder=stable_diffusion_model.text_encoder)
@@ -1819,6 +3122,7 @@ def generate_image_animatediff(prompt, negative_prompt, input_video, strength, s
                 generator=torch.manual_seed(-1),
             )
 
+            record_memory_peak(memory_plan)
             if stop_signal:
                 return None, "Generation stopped"
 
@@ -1881,8 +3185,8 @@ def generate_image_animatediff(prompt, negative_prompt, input_video, strength, s
                     print(f"{motion_lora_name} motion lora downloaded")
                 pipe.load_lora_weights(motion_lora_path, adapter_name=motion_lora_name)
 
-            pipe.enable_vae_slicing()
-            pipe.enable_model_cpu_offload()
+            memory_plan = plan_memory(pipe, "animatediff", width, height, num_frames=int(num_frames),
+                                      guidance=guidance_scale > 1)
 
             compel_proc = Compel(tokenizer=stable_diffusion_model.tokenizer,
                                  text_encoder=stable_diffusion_model.text_encoder)
@@ -1900,6 +3204,7 @@ def generate_image_animatediff(prompt, negative_prompt, input_video, strength, s
                 height=height,
             )
 
+            record_memory_peak(memory_plan)
             if stop_signal:
                 return None, "Generation stopped"
 
@@ -1948,15 +3253,13 @@ def generate_video(init_image, output_format, video_settings_html, motion_bucket
             print(f"StableVideoDiffusion model downloaded")
 
         try:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
             pipe = StableVideoDiffusionPipeline.from_pretrained(
                 pretrained_model_name_or_path=video_model_path,
                 torch_dtype=torch.float16,
                 variant="fp16"
             )
-            pipe.to(device)
-            pipe.enable_model_cpu_offload()
-            pipe.unet.enable_forward_chunking()
+            memory_plan = plan_memory(pipe, "svd", 1024, 576, num_frames=int(num_frames),
+                                      decode_batch_size=int(decode_chunk_size))
 
             image = load_image(init_image)
             image = image.resize((1024, 576))
@@ -1964,6 +3267,7 @@ def generate_video(init_image, output_format, video_settings_html, motion_bucket
             generator = torch.manual_seed(0)
             frames = pipe(image, decode_chunk_size=decode_chunk_size, generator=generator,
                           motion_bucket_id=motion_bucket_id, noise_aug_strength=noise_aug_strength, num_frames=num_frames).frames[0]
+            record_memory_peak(memory_plan)
 
             if stop_signal:
                 return None, None, "Generation stopped"
@@ -1992,10 +3296,9 @@ def generate_video(init_image, output_format, video_settings_html, motion_bucket
             print(f"i2vgen-xl model downloaded")
 
         try:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
             pipe = I2VGenXLPipeline.from_pretrained(video_model_path, torch_dtype=torch.float16, variant="fp16")
-            pipe.to(device)
-            pipe.enable_model_cpu_offload()
+            # I2VGen-XL samples 16 frames at 1280x704 by default
+            memory_plan = plan_memory(pipe, "i2vgen-xl", 1280, 704, num_frames=16, guidance=guidance_scale > 1)
 
             image = load_image(init_image).convert("RGB")
 
@@ -2009,6 +3312,7 @@ def generate_video(init_image, output_format, video_settings_html, motion_bucket
                 guidance_scale=guidance_scale,
                 generator=generator
             ).frames[0]
+            record_memory_peak(memory_plan)
 
             if stop_signal:
                 return None, None, "Generation stopped"
@@ -2703,55 +4007,17 @@ def generate_image_wurstchen(prompt, negative_prompt, width, height, prior_steps
         torch.cuda.empty_cache()
 
 
-def generate_image_deepfloyd(prompt, negative_prompt, num_inference_steps, guidance_scale, width, height, output_format="png", stop_generation=None):
-    global stop_signal
-    stop_signal = False
-
-    if not prompt:
-        return None, None, None, "Please enter a prompt!"
-
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-
-        # Stage I
+def get_deepfloyd_pipelines():
+    global deepfloyd_pipelines
+    if deepfloyd_pipelines is None:
         pipe_i = IFPipeline.from_pretrained("DeepFloyd/IF-I-XL-v1.0", variant="fp16", torch_dtype=torch.float16)
-        pipe_i.to(device)
         pipe_i.enable_model_cpu_offload()
 
-        prompt_embeds, negative_embeds = pipe_i.encode_prompt(prompt)
-        image = pipe_i(
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_embeds,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            width=width,
-            height=height,
-            output_type="pt"
-        ).images
-
-        if stop_signal:
-            return None, None, None, "Generation stopped"
-
-        # Stage II
         pipe_ii = IFSuperResolutionPipeline.from_pretrained(
             "DeepFloyd/IF-II-L-v1.0", text_encoder=None, variant="fp16", torch_dtype=torch.float16
         )
-        pipe_ii.to(device)
         pipe_ii.enable_model_cpu_offload()
 
-        image = pipe_ii(
-            image=image,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_embeds,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            output_type="pt"
-        ).images
-
-        if stop_signal:
-            return None, None, None, "Generation stopped"
-
-        # Stage III
         safety_modules = {
             "feature_extractor": pipe_i.feature_extractor,
             "safety_checker": pipe_i.safety_checker,
@@ -2760,47 +4026,125 @@ def generate_image_deepfloyd(prompt, negative_prompt, num_inference_steps, guida
         pipe_iii = DiffusionPipeline.from_pretrained(
             "stabilityai/stable-diffusion-x4-upscaler", **safety_modules, torch_dtype=torch.float16
         )
-        pipe_iii.to(device)
         pipe_iii.enable_model_cpu_offload()
 
-        image = pipe_iii(
-            prompt=prompt,
-            image=image,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-        ).images[0]
+        deepfloyd_pipelines = (pipe_i, pipe_ii, pipe_iii)
+    return deepfloyd_pipelines
+
+
+def get_deepfloyd_cached(cache, key, compute):
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key], True
+    value = compute()
+    cache[key] = value
+    while len(cache) > deepfloyd_cache_max_entries:
+        cache.popitem(last=False)
+    return value, False
 
-        if stop_signal:
-            return None, None, None, "Generation stopped"
+
+def generate_image_deepfloyd(prompt, negative_prompt, num_inference_steps, guidance_scale, width, height, seed,
+                             stage_iii_steps, stage_iii_guidance_scale, output_format="png", stop_generation=None):
+    global stop_signal
+    stop_signal = False
+
+    if not prompt:
+        yield None, None, None, "Please enter a prompt!"
+        return
+
+    try:
+        pipe_i, pipe_ii, pipe_iii = get_deepfloyd_pipelines()
+
+        seed = int(seed)
+        if seed < 0:
+            seed = random.randint(0, 2 ** 32 - 1)
+
+        # Width and height are the final (Stage III) size, stages I and II run at 1/16 and 1/4 of it
+        stage_i_width, stage_i_height = int(width) // 16, int(height) // 16
 
         today = datetime.now().date()
         image_dir = os.path.join('outputs', f"DeepFloydIF_{today.strftime('%Y%m%d')}")
         os.makedirs(image_dir, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
 
-        stage_i_filename = f"deepfloyd_if_stage_I_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
-        stage_ii_filename = f"deepfloyd_if_stage_II_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
-        stage_iii_filename = f"deepfloyd_if_stage_III_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
+        prompt_key = (prompt, negative_prompt)
+        (prompt_embeds, negative_embeds), _ = get_deepfloyd_cached(
+            deepfloyd_prompt_cache, prompt_key,
+            lambda: pipe_i.encode_prompt(prompt, negative_prompt=negative_prompt or None)
+        )
 
-        stage_i_path = os.path.join(image_dir, stage_i_filename)
-        stage_ii_path = os.path.join(image_dir, stage_ii_filename)
-        stage_iii_path = os.path.join(image_dir, stage_iii_filename)
+        # Stage I
+        stage_i_key = prompt_key + (seed, num_inference_steps, guidance_scale, stage_i_width, stage_i_height)
+        stage_i_image, stage_i_cached = get_deepfloyd_cached(
+            deepfloyd_stage_i_cache, stage_i_key,
+            lambda: pipe_i(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                width=stage_i_width,
+                height=stage_i_height,
+                generator=torch.manual_seed(seed),
+                output_type="pt"
+            ).images
+        )
+
+        stage_i_path = os.path.join(image_dir, f"deepfloyd_if_stage_I_{timestamp}.{output_format}")
+        pt_to_pil(stage_i_image)[0].save(stage_i_path)
+        yield stage_i_path, None, None, f"Stage I {'(cached) ' if stage_i_cached else ''}done, seed: {seed}"
+
+        if stop_signal:
+            yield stage_i_path, None, None, "Generation stopped"
+            return
+
+        # Stage II
+        stage_ii_key = stage_i_key
+        stage_ii_image, stage_ii_cached = get_deepfloyd_cached(
+            deepfloyd_stage_ii_cache, stage_ii_key,
+            lambda: pipe_ii(
+                image=stage_i_image,
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                width=stage_i_width * 4,
+                height=stage_i_height * 4,
+                generator=torch.manual_seed(seed),
+                output_type="pt"
+            ).images
+        )
+
+        stage_ii_path = os.path.join(image_dir, f"deepfloyd_if_stage_II_{timestamp}.{output_format}")
+        pt_to_pil(stage_ii_image)[0].save(stage_ii_path)
+        yield stage_i_path, stage_ii_path, None, f"Stage II {'(cached) ' if stage_ii_cached else ''}done, seed: {seed}"
 
-        pt_to_pil(image[0])[0].save(stage_i_path)
-        pt_to_pil(image[0])[0].save(stage_ii_path)
+        if stop_signal:
+            yield stage_i_path, stage_ii_path, None, "Generation stopped"
+            return
+
+        # Stage III
+        image = pipe_iii(
+            prompt=prompt,
+            negative_prompt=negative_prompt or None,
+            image=stage_ii_image,
+            num_inference_steps=stage_iii_steps,
+            guidance_scale=stage_iii_guidance_scale,
+            generator=torch.manual_seed(seed),
+        ).images[0]
+
+        if stop_signal:
+            yield stage_i_path, stage_ii_path, None, "Generation stopped"
+            return
+
+        stage_iii_path = os.path.join(image_dir, f"deepfloyd_if_stage_III_{timestamp}.{output_format}")
         image.save(stage_iii_path)
 
-        return stage_i_path, stage_ii_path, stage_iii_path, None
+        yield stage_i_path, stage_ii_path, stage_iii_path, f"Seed: {seed}"
 
     except Exception as e:
-        return None, None, None, str(e)
+        yield None, None, None, str(e)
 
     finally:
-        try:
-            del pipe_i
-            del pipe_ii
-            del pipe_iii
-        except:
-            pass
         torch.cuda.empty_cache()
 
 
@@ -3472,113 +4816,190 @@ def generate_stableaudio(prompt, negative_prompt, num_inference_steps, guidance_
         torch.cuda.empty_cache()
 
 
+def get_audiocraft_model(model_name, model_type):
+    key = (model_name, model_type)
+    if key in audiocraft_models:
+        audiocraft_models.move_to_end(key)
+        return audiocraft_models[key]
+
+    model_path = load_audiocraft_model(model_name)
+    if model_type == "musicgen":
+        model = MusicGen.get_pretrained(model_path)
+    elif model_type == "audiogen":
+        model = AudioGen.get_pretrained(model_path)
+    elif model_type == "magnet":
+        model = MAGNeT.get_pretrained(model_path)
+    else:
+        raise ValueError("Invalid model type!")
+
+    audiocraft_models[key] = model
+    while len(audiocraft_models) > audiocraft_max_models:
+        audiocraft_models.popitem(last=False)
+        torch.cuda.empty_cache()
+    return model
+
+
+def get_multiband_diffusion_model():
+    global multiband_diffusion_model
+    if multiband_diffusion_model is None:
+        multiband_diffusion_model = MultiBandDiffusion.get_mbd_musicgen()
+    return multiband_diffusion_model
+
+
+def generate_musicgen_windows(model, descriptions, duration, generation_params, window_duration=30, overlap_duration=10):
+    # Continuing from the overlap tokens skips re-encoding the prompt audio, but needs the private audiocraft
+    # token API (audiocraft 1.x); without it every window continues from the decoded overlap instead
+    use_tokens = hasattr(model, "_prepare_tokens_and_attributes") and hasattr(model, "_generate_tokens")
+    if use_tokens:
+        attributes, _ = model._prepare_tokens_and_attributes(descriptions, None)
+    prompt_tokens = None
+    prompt_wav = None
+    generated_duration = 0.0
+
+    while generated_duration < duration:
+        if stop_signal:
+            return
+        if use_tokens:
+            prompt_duration = 0.0 if prompt_tokens is None else prompt_tokens.shape[-1] / model.frame_rate
+        else:
+            prompt_duration = 0.0 if prompt_wav is None else prompt_wav.shape[-1] / model.sample_rate
+        window = min(window_duration, duration - generated_duration + prompt_duration)
+        model.set_generation_params(duration=window, **generation_params)
+        if use_tokens:
+            tokens = model._generate_tokens(attributes, prompt_tokens)
+            full_wav = model.generate_audio(tokens)
+            prompt_tokens = tokens[..., -int(overlap_duration * model.frame_rate):]
+        elif prompt_wav is None:
+            full_wav = model.generate(descriptions)
+        else:
+            full_wav = model.generate_continuation(prompt_wav, model.sample_rate, descriptions)
+        if not use_tokens:
+            prompt_wav = full_wav[..., -int(overlap_duration * model.sample_rate):]
+        wav = full_wav[..., int(prompt_duration * model.sample_rate):]
+        if wav.shape[-1] == 0:
+            return
+        generated_duration += wav.shape[-1] / model.sample_rate
+        yield wav
+
+
+def write_audiocraft_audio(audio_path, wav, sample_rate, output_format):
+    audio_format = output_format if output_format in ["mp3", "ogg"] else "wav"
+    audio_write(audio_path, wav, sample_rate, strategy="loudness", loudness_compressor=True, format=audio_format)
+    return f"{audio_path}.{output_format}"
+
+
 def generate_audio_audiocraft(prompt, input_audio=None, model_name=None, audiocraft_settings_html=None, model_type="musicgen",
-                              duration=10, top_k=250, top_p=0.0,
+                              duration=10, num_variations=1, enable_long_form=False, top_k=250, top_p=0.0,
                               temperature=1.0, cfg_coef=3.0, enable_multiband=False, output_format="mp3", stop_generation=None):
-    global audiocraft_model_path, stop_signal
+    global stop_signal
     stop_signal = False
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-
     if not model_name:
-        return None, "Please, select an AudioCraft model!"
+        yield None, None, "Please, select an AudioCraft model!"
+        return
+
+    if enable_long_form and (model_type != "musicgen" or input_audio or enable_multiband):
+        yield None, None, "Long-form generation works only with 'musicgen' models without melody audio and Multiband Diffusion"
+        return
 
     if enable_multiband and model_type in ["audiogen", "magnet"]:
-        return None, "Multiband Diffusion is not supported with 'audiogen' or 'magnet' model types. Please select 'musicgen' or disable Multiband Diffusion"
+        yield None, None, "Multiband Diffusion is not supported with 'audiogen' or 'magnet' model types. Please select 'musicgen' or disable Multiband Diffusion"
+        return
 
-    if not audiocraft_model_path:
-        audiocraft_model_path = load_audiocraft_model(model_name)
+    descriptions = [description.strip() for description in prompt.splitlines() if description.strip()]
+    if not descriptions:
+        yield None, None, "Please, enter your prompt!"
+        return
+    descriptions = [description for description in descriptions for _ in range(int(num_variations))]
 
     today = datetime.now().date()
     audio_dir = os.path.join('outputs', f"AudioCraft_{today.strftime('%Y%m%d')}")
     os.makedirs(audio_dir, exist_ok=True)
 
     try:
-        if model_type == "musicgen":
-            model = MusicGen.get_pretrained(audiocraft_model_path)
-            model.set_generation_params(duration=duration)
-        elif model_type == "audiogen":
-            model = AudioGen.get_pretrained(audiocraft_model_path)
-            model.set_generation_params(duration=duration)
-        elif model_type == "magnet":
-            model = MAGNeT.get_pretrained(audiocraft_model_path)
-            model.set_generation_params()
-        else:
-            return None, "Invalid model type!"
+        model = get_audiocraft_model(model_name, model_type)
     except (ValueError, AssertionError):
-        return None, "The selected model is not compatible with the chosen model type"
+        yield None, None, "The selected model is not compatible with the chosen model type"
+        return
 
     mbd = None
 
     if enable_multiband:
-        mbd = MultiBandDiffusion.get_mbd_musicgen()
+        mbd = get_multiband_diffusion_model()
 
     try:
+        if enable_long_form:
+            generation_params = dict(top_k=top_k, top_p=top_p, temperature=temperature, cfg_coef=cfg_coef)
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            windows = []
+            progress_bar = tqdm(total=duration, desc="Generating audio")
+            for window_index, wav in enumerate(generate_musicgen_windows(model, descriptions, duration, generation_params)):
+                wav = wav.cpu()
+                windows.append(wav)
+                chunk_path = os.path.join(audio_dir, f"audio_{timestamp}_part{window_index:03d}.wav")
+                sf.write(chunk_path, wav[0].numpy().T, model.sample_rate)
+                progress_bar.update(wav.shape[-1] / model.sample_rate)
+                yield chunk_path, None, None
+            progress_bar.close()
+            if not windows:
+                yield None, None, "Generation stopped"
+                return
+
+            # Full tracks are written like the short path does, so every output format works in both
+            wav = torch.cat(windows, dim=-1)
+            audio_paths = []
+            for i in range(wav.shape[0]):
+                suffix = f"_{i}" if wav.shape[0] > 1 else ""
+                audio_path = os.path.join(audio_dir, f"audio_{timestamp}{suffix}")
+                audio_paths.append(write_audiocraft_audio(audio_path, wav[i], model.sample_rate, output_format))
+            # The streaming player appends every yielded chunk, the finished files only go to the file output
+            yield None, audio_paths, "Generation stopped" if stop_signal else None
+            return
+
         progress_bar = tqdm(total=duration, desc="Generating audio")
-        if input_audio and model_type == "musicgen":
-            audio_path = input_audio
-            melody, sr = torchaudio.load(audio_path)
-            model.set_generation_params(duration=duration, top_k=top_k, top_p=top_p, temperature=temperature,
-                                        cfg_coef=cfg_coef)
-            wav, tokens = model.generate_with_chroma([prompt], melody[None].expand(1, -1, -1), sr, return_tokens=True)
-            progress_bar.update(duration)
-            if wav.ndim > 2:
-                wav = wav.squeeze()
-            if stop_signal:
-                return None, "Generation stopped"
+        tokens = None
+        if model_type == "magnet":
+            model.set_generation_params()
         else:
-            descriptions = [prompt]
             model.set_generation_params(duration=duration, top_k=top_k, top_p=top_p, temperature=temperature,
                                         cfg_coef=cfg_coef)
-            if model_type == "musicgen":
-                wav, tokens = model.generate(descriptions, return_tokens=True)
-            elif model_type == "audiogen":
-                wav = model.generate(descriptions)
-            progress_bar.update(duration)
-            if wav.ndim > 2:
-                wav = wav.squeeze()
-            if stop_signal:
-                return None, "Generation stopped"
+        if input_audio and model_type == "musicgen":
+            melody = torch.from_numpy(load_audio_cached(input_audio, model.sample_rate, model.audio_channels))
+            sr = model.sample_rate
+            wav, tokens = model.generate_with_chroma(descriptions, melody[None].expand(len(descriptions), -1, -1), sr, return_tokens=True)
+        elif model_type == "musicgen":
+            wav, tokens = model.generate(descriptions, return_tokens=True)
+        else:
+            wav = model.generate(descriptions)
+        progress_bar.update(duration)
         progress_bar.close()
+        if stop_signal:
+            yield None, None, "Generation stopped"
+            return
 
         if mbd:
-            if stop_signal:
-                return None, "Generation stopped"
-            tokens = rearrange(tokens, "b n d -> n b d")
             wav_diffusion = mbd.tokens_to_wav(tokens)
-            wav_diffusion = wav_diffusion.squeeze()
-            if wav_diffusion.ndim == 1:
-                wav_diffusion = wav_diffusion.unsqueeze(0)
+            if wav_diffusion.ndim == 2:
+                wav_diffusion = wav_diffusion.unsqueeze(1)
             max_val = wav_diffusion.abs().max()
             if max_val > 1:
                 wav_diffusion = wav_diffusion / max_val
             wav_diffusion = wav_diffusion * 0.99
-            audio_filename_diffusion = f"audio_{datetime.now().strftime('%Y%m%d_%H%M%S')}_diffusion.wav"
-            audio_path_diffusion = os.path.join(audio_dir, audio_filename_diffusion)
-            torchaudio.save(audio_path_diffusion, wav_diffusion.cpu().detach(), model.sample_rate)
 
-        audio_filename = f"audio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{output_format}"
-        audio_path = os.path.join(audio_dir, audio_filename)
-        if output_format == "mp3":
-            audio_write(audio_path, wav.cpu(), model.sample_rate, strategy="loudness", loudness_compressor=True,
-                        format='mp3')
-        elif output_format == "ogg":
-            audio_write(audio_path, wav.cpu(), model.sample_rate, strategy="loudness", loudness_compressor=True,
-                        format='ogg')
-        else:
-            audio_write(audio_path, wav.cpu(), model.sample_rate, strategy="loudness", loudness_compressor=True)
+        audio_paths = []
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        for i in range(wav.shape[0]):
+            suffix = f"_{i}" if wav.shape[0] > 1 else ""
+            if mbd:
+                audio_path_diffusion = os.path.join(audio_dir, f"audio_{timestamp}{suffix}_diffusion.wav")
+                torchaudio.save(audio_path_diffusion, wav_diffusion[i].cpu().detach(), model.sample_rate)
 
-        if output_format == "mp3":
-            return audio_path + ".mp3", None
-        elif output_format == "ogg":
-            return audio_path + ".ogg", None
-        else:
-            return audio_path + ".wav", None
+            audio_path = os.path.join(audio_dir, f"audio_{timestamp}{suffix}")
+            audio_paths.append(write_audiocraft_audio(audio_path, wav[i].cpu(), model.sample_rate, output_format))
+
+        yield audio_paths[0], audio_paths, None
 
     finally:
-        del model
-        if mbd:
-            del mbd
         torch.cuda.empty_cache()
 
 
@@ -3638,13 +5059,55 @@ def generate_audio_audioldm2(prompt, negative_prompt, model_name, num_inference_
         torch.cuda.empty_cache()
 
 
-def demucs_separate(audio_file, output_format="wav"):
+def get_demucs_model():
+    global demucs_model
+    if demucs_model is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        demucs_model = get_demucs_pretrained_model("htdemucs").to(device)
+        demucs_model.eval()
+    return demucs_model
+
+
+def save_stem(wav, stem_path, samplerate, output_format):
+    if output_format == "mp3":
+        save_audio(wav, stem_path, samplerate, bitrate=192)
+    elif output_format == "ogg":
+        sf.write(stem_path, wav.t().numpy(), samplerate, format='ogg')
+    else:
+        save_audio(wav, stem_path, samplerate)
+    return stem_path
+
+
+def separate_vocals(audio_path, separate_dir, output_format, prefix=""):
+    model = get_demucs_model()
+    device = next(model.parameters()).device
+
+    wav = torch.from_numpy(load_audio_cached(audio_path, model.samplerate, model.audio_channels))
+    ref = wav.mean(0)
+    ref_mean, ref_std = ref.mean(), ref.std() + 1e-8
+    wav = (wav - ref_mean) / ref_std
+
+    with torch.no_grad():
+        sources = apply_model(model, wav[None], device=device, split=True, overlap=0.25, progress=False)[0]
+    sources = (sources * ref_std + ref_mean).cpu()
+
+    vocals = sources[model.sources.index("vocals")]
+    instrumental = sources.sum(0) - vocals
+
+    vocal_output = os.path.join(separate_dir, f"{prefix}vocals.{output_format}")
+    instrumental_output = os.path.join(separate_dir, f"{prefix}instrumental.{output_format}")
+    return [audio_encode_executor.submit(save_stem, vocals, vocal_output, model.samplerate, output_format),
+            audio_encode_executor.submit(save_stem, instrumental, instrumental_output, model.samplerate, output_format)]
+
+
+def demucs_separate(audio_file, audio_files=None, output_format="wav"):
     global stop_signal
     if stop_signal:
-        return None, None, "Generation stopped"
+        return None, None, None, "Generation stopped"
 
-    if not audio_file:
-        return None, None, "Please upload an audio file!"
+    audio_paths = ([audio_file] if audio_file else []) + [file.name for file in audio_files or []]
+    if not audio_paths:
+        return None, None, None, "Please upload an audio file!"
 
     today = datetime.now().date()
     demucs_dir = os.path.join("outputs", f"Demucs_{today.strftime('%Y%m%d')}")
@@ -3655,39 +5118,25 @@ def demucs_separate(audio_file, output_format="wav"):
     os.makedirs(separate_dir, exist_ok=True)
 
     try:
-        command = f"demucs --two-stems=vocals {audio_file} -o {separate_dir}"
-        subprocess.run(command, shell=True, check=True)
-
-        if stop_signal:
-            return None, None, "Generation stopped"
-
-        temp_vocal_file = os.path.join(separate_dir, "htdemucs", os.path.splitext(os.path.basename(audio_file))[0], "vocals.wav")
-        temp_instrumental_file = os.path.join(separate_dir, "htdemucs", os.path.splitext(os.path.basename(audio_file))[0], "no_vocals.wav")
-
-        vocal_file = os.path.join(separate_dir, "vocals.wav")
-        instrumental_file = os.path.join(separate_dir, "instrumental.wav")
+        stem_futures = []
+        for audio_path in audio_paths:
+            if stop_signal:
+                break
+            prefix = f"{os.path.splitext(os.path.basename(audio_path))[0]}_" if len(audio_paths) > 1 else ""
+            stem_futures.extend(separate_vocals(audio_path, separate_dir, output_format, prefix))
 
-        os.rename(temp_vocal_file, vocal_file)
-        os.rename(temp_instrumental_file, instrumental_file)
+        stem_outputs = [future.result() for future in stem_futures]
 
-        if output_format == "mp3":
-            vocal_output = os.path.join(separate_dir, "vocal.mp3")
-            instrumental_output = os.path.join(separate_dir, "instrumental.mp3")
-            subprocess.run(f"ffmpeg -i {vocal_file} -b:a 192k {vocal_output}", shell=True, check=True)
-            subprocess.run(f"ffmpeg -i {instrumental_file} -b:a 192k {instrumental_output}", shell=True, check=True)
-        elif output_format == "ogg":
-            vocal_output = os.path.join(separate_dir, "vocal.ogg")
-            instrumental_output = os.path.join(separate_dir, "instrumental.ogg")
-            subprocess.run(f"ffmpeg -i {vocal_file} -c:a libvorbis -qscale:a 5 {vocal_output}", shell=True, check=True)
-            subprocess.run(f"ffmpeg -i {instrumental_file} -c:a libvorbis -qscale:a 5 {instrumental_output}", shell=True, check=True)
-        else:
-            vocal_output = vocal_file
-            instrumental_output = instrumental_file
+        if stop_signal:
+            return None, None, stem_outputs, "Generation stopped"
 
-        return vocal_output, instrumental_output, None
+        return stem_outputs[0], stem_outputs[1], stem_outputs, None
 
     except Exception as e:
-        return None, None, str(e)
+        return None, None, None, str(e)
+
+    finally:
+        torch.cuda.empty_cache()
 
 
 def get_output_files():
@@ -3700,7 +5149,7 @@ def get_output_files():
 
     for root, dirs, files in os.walk(output_dir):
         for file in files:
-            if file.endswith(".txt") or file.endswith(".json"):
+            if file.endswith(".txt") or file.endswith(".json") or file.endswith(".jsonl"):
                 text_files.append(os.path.join(root, file))
             elif file.endswith(".png") or file.endswith(".jpeg") or file.endswith(".gif"):
                 image_files.append(os.path.join(root, file))
@@ -3829,7 +5278,7 @@ def open_outputs_folder():
 
 llm_models_list = [None, "moondream2"] + [model for model in os.listdir("inputs/text/llm_models") if not model.endswith(".txt") and model != "vikhyatk" and model != "lora"]
 llm_lora_models_list = [None] + [model for model in os.listdir("inputs/text/llm_models/lora") if not model.endswith(".txt")]
-speaker_wavs_list = [None] + [wav for wav in os.listdir("inputs/audio/voices") if not wav.endswith(".txt")]
+speaker_wavs_list = [None] + [wav for wav in os.listdir("inputs/audio/voices") if not wav.endswith(".txt") and not wav.endswith(".pt")]
 stable_diffusion_models_list = [None] + [model.replace(".safetensors", "") for model in
                                          os.listdir("inputs/image/sd_models")
                                          if (model.endswith(".safetensors") or not model.endswith(".txt") and not os.path.isdir(os.path.join("inputs/image/sd_models")))]
@@ -3846,7 +5295,7 @@ inpaint_models_list = [None] + [model.replace(".safetensors", "") for model in
 controlnet_models_list = [None, "openpose", "depth", "canny", "lineart", "scribble", "ip-adapter", "ip-adapter-face"]
 
 chat_interface = gr.Interface(
-    fn=generate_text_and_speech,
+    fn=generate_text_and_speech_stream,
     inputs=[
         gr.Textbox(label="Enter your request"),
         gr.Audio(type="filepath", label="Record your request (optional)"),
@@ -3860,6 +5309,9 @@ chat_interface = gr.Interface(
         gr.Slider(minimum=0.0, maximum=2.0, value=0.7, step=0.1, label="Temperature"),
         gr.Slider(minimum=0.0, maximum=1.0, value=0.9, step=0.1, label="Top P"),
         gr.Slider(minimum=0, maximum=100, value=20, step=1, label="Top K"),
+        gr.Slider(minimum=256, maximum=32768, value=2048, step=256, label="Context token budget"),
+        gr.Dropdown(choices=llm_models_list, label="Select draft model for speculative decoding (optional, for transformers type models)", value=None),
+        gr.Slider(minimum=1, maximum=16, value=5, step=1, label="Draft tokens per step (for speculative decoding)"),
         gr.Radio(choices=["txt", "json"], label="Select chat history format", value="txt", interactive=True),
         gr.Checkbox(label="Enable WebSearch", value=False),
         gr.Checkbox(label="Enable LibreTranslate", value=False),
@@ -3878,7 +5330,7 @@ chat_interface = gr.Interface(
     ],
     outputs=[
         gr.Chatbot(label="LLM text response", value=[]),
-        gr.Audio(label="LLM audio response", type="filepath"),
+        gr.Audio(label="LLM audio response", type="filepath", streaming=True, autoplay=True),
     ],
     title="NeuroSandboxWebUI (ALPHA) - LLM",
     description="This user interface allows you to enter any text or audio and receive generated response. You can select the LLM model, "
@@ -3892,6 +5344,7 @@ tts_stt_interface = gr.Interface(
     inputs=[
         gr.Textbox(label="Enter text for TTS"),
         gr.Audio(label="Record audio for STT", type="filepath"),
+        gr.File(label="Upload audio files for STT (optional)", file_count="multiple", interactive=True),
         gr.HTML("<h3>TTS Settings</h3>"),
         gr.Dropdown(choices=speaker_wavs_list, label="Select voice", interactive=True),
         gr.Dropdown(choices=["en", "es", "fr", "de", "it", "pt", "pl", "tr", "ru", "nl", "cs", "ar", "zh-cn", "ja", "hu", "ko", "hi"], label="Select language", interactive=True),
@@ -3994,15 +5447,24 @@ txt2img_interface = gr.Interface(
                     label="Select sampler", value="euler_ancestral"),
         gr.Slider(minimum=1, maximum=100, value=30, step=1, label="Steps"),
         gr.Slider(minimum=1.0, maximum=30.0, value=8, step=0.1, label="CFG"),
-        gr.Slider(minimum=256, maximum=2048, value=512, step=64, label="Width"),
-        gr.Slider(minimum=256, maximum=2048, value=512, step=64, label="Height"),
+        gr.Slider(minimum=256, maximum=4096, value=512, step=64, label="Width"),
+        gr.Slider(minimum=256, maximum=4096, value=512, step=64, label="Height"),
         gr.Slider(minimum=1, maximum=4, value=1, step=1, label="Clip skip"),
         gr.Checkbox(label="Enable FreeU", value=False),
         gr.Checkbox(label="Enable Tiled VAE", value=False),
+        gr.Checkbox(label="Enable Tiled Diffusion", value=False),
+        gr.Slider(minimum=512, maximum=1536, value=768, step=64, label="Tile size"),
+        gr.Slider(minimum=0, maximum=256, value=128, step=32, label="Tile overlap"),
         gr.Checkbox(label="Enable Upscale", value=False),
         gr.Radio(choices=["x2", "x4"], label="Upscale size", value="x2"),
         gr.Slider(minimum=1, maximum=100, value=50, step=1, label="Upscale steps"),
         gr.Slider(minimum=1.0, maximum=30.0, value=6, step=0.1, label="Upscale CFG"),
+        gr.Textbox(label="Save latent snapshots at steps (e.g. 10,20), samples with Euler ancestral", value=""),
+        gr.Textbox(label="Vary from latent snapshot file (optional)", value=""),
+        gr.Slider(minimum=0, maximum=100, value=10, step=1, label="Vary from step"),
+        gr.Number(label="Variation seed (-1 for random)", value=-1, precision=0),
+        gr.Checkbox(label="Enable Turbo mode", value=False),
+        gr.Slider(minimum=1, maximum=4, value=1, step=1, label="Turbo steps"),
         gr.Radio(choices=["png", "jpeg"], label="Select output format", value="png", interactive=True),
         gr.Button(value="Stop generation", interactive=True, variant="stop"),
     ],
@@ -4033,6 +5495,9 @@ img2img_interface = gr.Interface(
         gr.Slider(minimum=1, maximum=100, value=30, step=1, label="Steps"),
         gr.Slider(minimum=1.0, maximum=30.0, value=8, step=0.1, label="CFG"),
         gr.Slider(minimum=1, maximum=4, value=1, step=1, label="Clip skip"),
+        gr.Checkbox(label="Enable Tiled Diffusion", value=False),
+        gr.Slider(minimum=512, maximum=1536, value=768, step=64, label="Tile size"),
+        gr.Slider(minimum=0, maximum=256, value=128, step=32, label="Tile overlap"),
         gr.Radio(choices=["png", "jpeg"], label="Select output format", value="png", interactive=True),
         gr.Button(value="Stop generation", interactive=True, variant="stop"),
     ],
@@ -4159,6 +5624,8 @@ inpaint_interface = gr.Interface(
         gr.Image(label="Initial image", type="filepath"),
         gr.ImageEditor(label="Mask image", type="filepath"),
         gr.Slider(minimum=0, maximum=100, value=0, step=1, label="Mask Blur Factor"),
+        gr.Checkbox(label="Inpaint masked region only", value=False),
+        gr.Slider(minimum=0, maximum=256, value=32, step=4, label="Masked region padding"),
         gr.Dropdown(choices=inpaint_models_list, label="Select Inpaint model", value=None),
         gr.Dropdown(choices=vae_models_list, label="Select VAE model (optional)", value=None),
         gr.HTML("<h3>StableDiffusion Settings</h3>"),
@@ -4538,8 +6005,11 @@ deepfloyd_if_interface = gr.Interface(
         gr.Textbox(label="Enter your negative prompt", value=""),
         gr.Slider(minimum=1, maximum=100, value=50, step=1, label="Steps"),
         gr.Slider(minimum=0.1, maximum=30.0, value=6, step=0.1, label="Guidance Scale"),
-        gr.Slider(minimum=256, maximum=2048, value=512, step=64, label="Width"),
-        gr.Slider(minimum=256, maximum=2048, value=512, step=64, label="Height"),
+        gr.Slider(minimum=512, maximum=2048, value=1024, step=128, label="Width"),
+        gr.Slider(minimum=512, maximum=2048, value=1024, step=128, label="Height"),
+        gr.Number(label="Seed (-1 for random)", value=-1, precision=0),
+        gr.Slider(minimum=1, maximum=100, value=50, step=1, label="Stage III Steps"),
+        gr.Slider(minimum=0.1, maximum=30.0, value=9, step=0.1, label="Stage III Guidance Scale"),
         gr.Radio(choices=["png", "jpeg"], label="Select output format", value="png", interactive=True),
         gr.Button(value="Stop generation", interactive=True, variant="stop"),
     ],
@@ -4809,7 +6279,9 @@ audiocraft_interface = gr.Interface(
         gr.Dropdown(choices=audiocraft_models_list, label="Select AudioCraft model", value=None),
         gr.HTML("<h3>AudioCraft Settings</h3>"),
         gr.Radio(choices=["musicgen", "audiogen", "magnet"], label="Select model type", value="musicgen"),
-        gr.Slider(minimum=1, maximum=120, value=10, step=1, label="Duration (seconds)"),
+        gr.Slider(minimum=1, maximum=600, value=10, step=1, label="Duration (seconds)"),
+        gr.Slider(minimum=1, maximum=8, value=1, step=1, label="Variations per description (one description per line)"),
+        gr.Checkbox(label="Enable long-form streaming (musicgen, in 30 second windows)", value=False),
         gr.Slider(minimum=1, maximum=1000, value=250, step=1, label="Top K"),
         gr.Slider(minimum=0.0, maximum=1.0, value=0.0, step=0.1, label="Top P"),
         gr.Slider(minimum=0.0, maximum=1.9, value=1.0, step=0.1, label="Temperature"),
@@ -4819,7 +6291,8 @@ audiocraft_interface = gr.Interface(
         gr.Button(value="Stop generation", interactive=True, variant="stop"),
     ],
     outputs=[
-        gr.Audio(label="Generated audio", type="filepath"),
+        gr.Audio(label="Generated audio", type="filepath", streaming=True),
+        gr.File(label="All generated audio", file_count="multiple"),
         gr.Textbox(label="Message", type="text"),
     ],
     title="NeuroSandboxWebUI (ALPHA) - AudioCraft",
@@ -4856,11 +6329,13 @@ demucs_interface = gr.Interface(
     fn=demucs_separate,
     inputs=[
         gr.Audio(type="filepath", label="Audio file to separate"),
+        gr.File(label="Audio files to separate (optional)", file_count="multiple", interactive=True),
         gr.Radio(choices=["wav", "mp3", "ogg"], label="Select output format", value="wav", interactive=True),
     ],
     outputs=[
         gr.Audio(label="Vocal", type="filepath"),
         gr.Audio(label="Instrumental", type="filepath"),
+        gr.File(label="All separated stems", file_count="multiple"),
         gr.Textbox(label="Message", type="text"),
     ],
     title="NeuroSandboxWebUI (ALPHA) - Demucs",
@@ -5015,6 +6490,9 @@ with gr.TabbedInterface(
     folder_button = gr.Button("Outputs")
     folder_button.click(open_outputs_folder, [], [], queue=False)
 
+    export_history_button = gr.Button("Export histories")
+    export_history_button.click(export_history_logs, [], [], queue=False)
+
     github_link = gr.HTML(
         '<div style="text-align: center; margin-top: 20px;">'
         '<a href="https://github.com/Dartvauder/NeuroSandboxWebUI" target="_blank" style="color: blue; text-decoration: none; font-size: 16px; margin-right: 20px;">'
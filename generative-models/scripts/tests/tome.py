@@ -0,0 +1,106 @@
+import torch
+import torch.nn.functional as F
+import torch.utils.benchmark as benchmark
+from torch import nn
+
+from sgm.modules.attention import apply_token_merging, remove_token_merging
+from sgm.modules.diffusionmodules.openaimodel import UNetModel
+
+
+def psnr(x, ref):
+    mse = F.mse_loss(x, ref)
+    data_range = ref.max() - ref.min()
+    return (10 * torch.log10(data_range**2 / mse)).item()
+
+
+def ssim(x, ref, window_size=7):
+    # mean SSIM over all channels, with each map normalized to [0, 1] by the reference range
+    lo, hi = ref.amin(dim=(2, 3), keepdim=True), ref.amax(dim=(2, 3), keepdim=True)
+    x = (x - lo) / (hi - lo)
+    ref = (ref - lo) / (hi - lo)
+    c1, c2 = 0.01**2, 0.03**2
+
+    def pool(t):
+        return F.avg_pool2d(t, window_size, stride=1)
+
+    mu_x, mu_r = pool(x), pool(ref)
+    var_x = pool(x * x) - mu_x**2
+    var_r = pool(ref * ref) - mu_r**2
+    cov = pool(x * ref) - mu_x * mu_r
+    ssim_map = ((2 * mu_x * mu_r + c1) * (2 * cov + c2)) / (
+        (mu_x**2 + mu_r**2 + c1) * (var_x + var_r + c2)
+    )
+    return ssim_map.mean().item()
+
+
+def benchmark_tome():
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+
+    def benchmark_torch_function_in_milliseconds(f, *args, **kwargs):
+        t0 = benchmark.Timer(
+            stmt="f(*args, **kwargs)", globals={"args": args, "kwargs": kwargs, "f": f}
+        )
+        return t0.blocked_autorange().mean * 1e3
+
+    # a reduced SD-2.x style UNet, small enough to run on CPU
+    torch.manual_seed(0)
+    model = UNetModel(
+        in_channels=4,
+        model_channels=64,
+        out_channels=4,
+        num_res_blocks=1,
+        attention_resolutions=[4, 2, 1],
+        channel_mult=[1, 2, 4, 4],
+        num_head_channels=32,
+        transformer_depth=1,
+        context_dim=256,
+        use_linear_in_transformer=True,
+        spatial_transformer_attn_type="softmax",
+    )
+    # the output projections are zero-initialized, which would hide the effect of
+    # merging completely with random weights
+    for module in model.modules():
+        if isinstance(module, (nn.Linear, nn.Conv2d)) and not module.weight.any():
+            nn.init.normal_(module.weight, std=0.02)
+    model = model.to(device=device, dtype=dtype).eval()
+
+    batch_size = 2
+    latent_size = 96  # 768px images
+    # smooth, image-like latents: tokens of natural images are highly redundant
+    x = F.interpolate(
+        torch.randn(batch_size, 4, latent_size // 8, latent_size // 8),
+        size=(latent_size, latent_size),
+        mode="bicubic",
+    ).to(device=device, dtype=dtype)
+    t = torch.full((batch_size,), 500, device=device)
+    c = torch.randn(batch_size, 77, 256, device=device, dtype=dtype)
+
+    print(f"latent shape: {tuple(x.shape)}, device: {device}")
+
+    with torch.no_grad():
+        remove_token_merging(model)
+        reference = model(x, timesteps=t, context=c).float()
+        baseline = benchmark_torch_function_in_milliseconds(
+            model, x, timesteps=t, context=c
+        )
+        print(f"{'ratio':>16} {'ms':>10} {'speedup':>8} {'PSNR':>8} {'SSIM':>8}")
+        print(f"{'none':>16} {baseline:10.1f} {1.0:8.2f} {'inf':>8} {1.0:8.4f}")
+
+        for ratio in [0.3, 0.5, 0.7, (0.5, 0.3)]:
+            apply_token_merging(model, ratio=ratio, use_rand=False)
+            out = model(x, timesteps=t, context=c).float()
+            runtime = benchmark_torch_function_in_milliseconds(
+                model, x, timesteps=t, context=c
+            )
+            print(
+                f"{str(ratio):>16} {runtime:10.1f} {baseline / runtime:8.2f} "
+                f"{psnr(out, reference):8.2f} {ssim(out, reference):8.4f}"
+            )
+        remove_token_merging(model)
+
+
+if __name__ == "__main__":
+    benchmark_tome()
+
+    print("done.")
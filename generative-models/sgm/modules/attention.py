@@ -453,6 +453,177 @@ class MemoryEfficientCrossAttention(nn.Module):
         return self.to_out(out)
 
 
+# token merging (ToMe for SD, https://arxiv.org/abs/2303.17604)
+def do_nothing(x, mode=None):
+    return x
+
+
+def bipartite_soft_matching_random2d(
+    metric: torch.Tensor,
+    w: int,
+    h: int,
+    sx: int,
+    sy: int,
+    r: int,
+    use_rand: bool = True,
+    generator: Optional[torch.Generator] = None,
+):
+    """
+    Partitions the tokens into src and dst and merges r tokens from src to dst.
+    Dst tokens are partitioned by choosing one randomly in each (sx, sy) region.
+    The random choice is drawn from generator, so that the global RNG stream of
+    the sampler is left untouched.
+    Returns a merge and an unmerge function, both operating on b, n, c tensors.
+    """
+    B, N, _ = metric.shape
+
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    gather = torch.gather
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+
+        # for each (sy, sx) region, pick one token as dst (marked with -1)
+        if use_rand:
+            rand_idx = torch.randint(
+                sy * sx,
+                size=(hsy, wsx, 1),
+                device=generator.device if generator is not None else metric.device,
+                generator=generator,
+            ).to(metric.device)
+        else:
+            rand_idx = torch.zeros(
+                hsy, wsx, 1, device=metric.device, dtype=torch.int64
+            )
+
+        idx_buffer_view = torch.zeros(
+            hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64
+        )
+        idx_buffer_view.scatter_(
+            dim=2, index=rand_idx, src=-torch.ones_like(rand_idx, dtype=rand_idx.dtype)
+        )
+        idx_buffer_view = (
+            idx_buffer_view.view(hsy, wsx, sy, sx)
+            .transpose(1, 2)
+            .reshape(hsy * sy, wsx * sx)
+        )
+
+        # tokens outside of the (sy, sx) grid are always src
+        if (hsy * sy) < h or (wsx * sx) < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[: (hsy * sy), : (wsx * sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+
+        # dst tokens (-1) sort to the front
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        del idx_buffer, idx_buffer_view
+
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]  # src
+        b_idx = rand_idx[:, :num_dst, :]  # dst
+
+        def split(x):
+            C = x.shape[-1]
+            src = gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        # can't reduce more than the number of src tokens
+        r = min(a.shape[1], r)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+
+        unm_idx = edge_idx[..., r:, :]  # unmerged src tokens
+        src_idx = edge_idx[..., :r, :]  # merged src tokens
+        dst_idx = gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
+        src, dst = split(x)
+        n, t1, c = src.shape
+
+        unm = gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x: torch.Tensor) -> torch.Tensor:
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        _, _, c = unm.shape
+
+        src = gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+
+        # combine back to the original shape
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(
+            dim=-2,
+            index=gather(
+                a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx
+            ).expand(B, unm_len, c),
+            src=unm,
+        )
+        out.scatter_(
+            dim=-2,
+            index=gather(
+                a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx
+            ).expand(B, r, c),
+            src=src,
+        )
+
+        return out
+
+    return merge, unmerge
+
+
+def compute_token_merging(x: torch.Tensor, tome_info: dict):
+    """
+    Builds the merge/unmerge functions for a b, (h w), c token sequence, using the
+    spatial size of the model input recorded in tome_info to recover h, w and the
+    block depth (0 = full latent resolution, 1 = downsampled once, ...).
+    """
+    original_h, original_w = tome_info["size"]
+    original_tokens = original_h * original_w
+    downsample = int(math.ceil(math.sqrt(original_tokens // x.shape[1])))
+    depth = int(math.log2(downsample)) if downsample > 0 else 0
+
+    ratio = tome_info["ratio"]
+    ratio = ratio[depth] if depth < len(ratio) else 0.0
+    if ratio <= 0.0:
+        return (do_nothing,) * 6
+
+    w = int(math.ceil(original_w / downsample))
+    h = int(math.ceil(original_h / downsample))
+    if h * w != x.shape[1]:
+        return (do_nothing,) * 6
+
+    r = int(x.shape[1] * ratio)
+    m, u = bipartite_soft_matching_random2d(
+        x,
+        w,
+        h,
+        tome_info["sx"],
+        tome_info["sy"],
+        r,
+        use_rand=tome_info["use_rand"],
+        generator=tome_info["generator"],
+    )
+
+    m_a, u_a = (m, u) if tome_info["merge_attn"] else (do_nothing, do_nothing)
+    m_c, u_c = (m, u) if tome_info["merge_crossattn"] else (do_nothing, do_nothing)
+    m_m, u_m = (m, u) if tome_info["merge_mlp"] else (do_nothing, do_nothing)
+    return m_a, m_c, m_m, u_a, u_c, u_m
+
+
 class BasicTransformerBlock(nn.Module):
     ATTENTION_MODES = {
         "softmax": CrossAttention,  # vanilla attention
@@ -523,6 +694,7 @@ class BasicTransformerBlock(nn.Module):
         self.checkpoint = checkpoint
         if self.checkpoint:
             logpy.debug(f"{self.__class__.__name__} is using checkpointing")
+        self.tome_info = None  # set by apply_token_merging
 
     def forward(
         self, x, context=None, additional_tokens=None, n_times_crossframe_attn_in_self=0
@@ -551,24 +723,40 @@ class BasicTransformerBlock(nn.Module):
     def _forward(
         self, x, context=None, additional_tokens=None, n_times_crossframe_attn_in_self=0
     ):
+        if (
+            self.tome_info is not None
+            and self.tome_info["size"] is not None
+            and additional_tokens is None
+            and not n_times_crossframe_attn_in_self
+        ):
+            m_a, m_c, m_m, u_a, u_c, u_m = compute_token_merging(x, self.tome_info)
+        else:
+            m_a, m_c, m_m, u_a, u_c, u_m = (do_nothing,) * 6
+
         x = (
-            self.attn1(
-                self.norm1(x),
-                context=context if self.disable_self_attn else None,
-                additional_tokens=additional_tokens,
-                n_times_crossframe_attn_in_self=n_times_crossframe_attn_in_self
-                if not self.disable_self_attn
-                else 0,
+            u_a(
+                self.attn1(
+                    m_a(self.norm1(x)),
+                    context=context if self.disable_self_attn else None,
+                    additional_tokens=additional_tokens,
+                    n_times_crossframe_attn_in_self=n_times_crossframe_attn_in_self
+                    if not self.disable_self_attn
+                    else 0,
+                )
             )
             + x
         )
         x = (
-            self.attn2(
-                self.norm2(x), context=context, additional_tokens=additional_tokens
+            u_c(
+                self.attn2(
+                    m_c(self.norm2(x)),
+                    context=context,
+                    additional_tokens=additional_tokens,
+                )
             )
             + x
         )
-        x = self.ff(self.norm3(x)) + x
+        x = u_m(self.ff(m_m(self.norm3(x)))) + x
         return x
 
 
@@ -723,6 +911,75 @@ class SpatialTransformer(nn.Module):
         return x + x_in
 
 
+def apply_token_merging(
+    model: nn.Module,
+    ratio=0.5,
+    sx: int = 2,
+    sy: int = 2,
+    use_rand: bool = True,
+    merge_attn: bool = True,
+    merge_crossattn: bool = False,
+    merge_mlp: bool = True,
+    seed: int = 0,
+) -> nn.Module:
+    """
+    Enables token merging for every BasicTransformerBlock in model.
+    ratio is either a float, which is applied to the blocks at full latent
+    resolution only, or a sequence with one merge ratio per block depth
+    (downsampling level), e.g. (0.5, 0.3) for the two outermost levels.
+    The model's first forward argument must be the (latent) image, whose spatial
+    size is recorded on every call to recover the token layout inside the blocks.
+    With use_rand, the dst partitions are drawn from a dedicated generator that is
+    seeded with seed once and then advances with every block and step, so a
+    sampling run is reproducible and does not shift the global RNG used by the
+    sampler. Apply token merging again to restart from seed for the next run.
+    """
+    remove_token_merging(model)
+    if isinstance(ratio, (int, float)):
+        ratio = (float(ratio),)
+
+    tome_info = {
+        "size": None,
+        "ratio": tuple(ratio),
+        "sx": sx,
+        "sy": sy,
+        "use_rand": use_rand,
+        "seed": seed,
+        "generator": None,
+        "merge_attn": merge_attn,
+        "merge_crossattn": merge_crossattn,
+        "merge_mlp": merge_mlp,
+    }
+
+    def record_size(module, args, kwargs):
+        x = args[0] if len(args) > 0 else kwargs["x"]
+        tome_info["size"] = x.shape[-2:]
+        if use_rand:
+            # MPS has no device generators, draw on the CPU there
+            device = x.device if x.device.type != "mps" else torch.device("cpu")
+            generator = tome_info["generator"]
+            if generator is None or generator.device != device:
+                tome_info["generator"] = torch.Generator(device=device).manual_seed(
+                    tome_info["seed"]
+                )
+
+    model._tome_hook = model.register_forward_pre_hook(record_size, with_kwargs=True)
+    for module in model.modules():
+        if isinstance(module, BasicTransformerBlock):
+            module.tome_info = tome_info
+    return model
+
+
+def remove_token_merging(model: nn.Module) -> nn.Module:
+    if hasattr(model, "_tome_hook"):
+        model._tome_hook.remove()
+        del model._tome_hook
+    for module in model.modules():
+        if isinstance(module, BasicTransformerBlock):
+            module.tome_info = None
+    return model
+
+
 class SimpleTransformer(nn.Module):
     def __init__(
         self,
@@ -11,6 +11,14 @@ logpy = logging.getLogger(__name__)
 
 
 class Guider(ABC):
+    # CFG truncation, see `set_guidance_interval`; the defaults guide every step
+    guidance_interval: Optional[Tuple[float, float]] = None
+    guidance_stop: Optional[float] = None
+    adaptive_threshold: Optional[float] = None
+    sigma_stop: Optional[float] = None
+    converged: bool = False
+    guidance_active: bool = True
+
     @abstractmethod
     def __call__(self, x: torch.Tensor, sigma: float) -> torch.Tensor:
         pass
@@ -20,17 +28,90 @@ class Guider(ABC):
     ) -> Tuple[torch.Tensor, float, Dict]:
         pass
 
+    def set_guidance_interval(
+        self,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_stop: Optional[float] = None,
+        adaptive_threshold: Optional[float] = None,
+    ):
+        """
+        Limits on which steps the unconditional branch is evaluated. Outside of
+        the interval the guider returns the conditional prediction and the
+        sampler only runs a half-size batch.
+
+        :param guidance_interval: (sigma_min, sigma_max), guide only for sigmas
+            in this range.
+        :param guidance_stop: fraction of the sampling steps after which
+            guidance is turned off.
+        :param adaptive_threshold: turn guidance off for the remaining steps once
+            the relative difference between the conditional and unconditional
+            predictions drops below this value.
+        """
+        if guidance_interval is not None:
+            guidance_interval = tuple(guidance_interval)
+            assert len(guidance_interval) == 2, "expected (sigma_min, sigma_max)"
+        if guidance_stop is not None:
+            assert 0.0 <= guidance_stop <= 1.0, "guidance_stop is a step fraction"
+        self.guidance_interval = guidance_interval
+        self.guidance_stop = guidance_stop
+        self.adaptive_threshold = adaptive_threshold
+
+    def reset(self, sigmas: torch.Tensor):
+        """Called by the sampler with the full sigma schedule before sampling."""
+        self.converged = False
+        self.sigma_stop = None
+        if self.guidance_stop is not None:
+            num_steps = len(sigmas) - 1
+            self.sigma_stop = sigmas[round(self.guidance_stop * num_steps)].item()
+
+    def use_guidance(self, s: torch.Tensor) -> bool:
+        if self.converged:
+            return False
+        if self.guidance_interval is None and self.sigma_stop is None:
+            return True
+        sigma = s.max().item()
+        if self.guidance_interval is not None:
+            sigma_min, sigma_max = self.guidance_interval
+            if not sigma_min <= sigma <= sigma_max:
+                return False
+        return self.sigma_stop is None or sigma > self.sigma_stop
+
+    def update_convergence(self, x_u: torch.Tensor, x_c: torch.Tensor):
+        if self.adaptive_threshold is None:
+            return
+        delta = (x_c - x_u).norm() / x_c.norm().clamp(min=1e-8)
+        if delta.item() < self.adaptive_threshold:
+            logpy.info(
+                f"{self.__class__.__name__}: predictions converged "
+                f"(delta={delta.item():.4f}), dropping the unconditional pass"
+            )
+            self.converged = True
+
 
 class VanillaCFG(Guider):
-    def __init__(self, scale: float):
+    def __init__(
+        self,
+        scale: float,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_stop: Optional[float] = None,
+        adaptive_threshold: Optional[float] = None,
+    ):
         self.scale = scale
+        self.set_guidance_interval(guidance_interval, guidance_stop, adaptive_threshold)
 
     def __call__(self, x: torch.Tensor, sigma: torch.Tensor) -> torch.Tensor:
+        if not self.guidance_active:
+            return x
         x_u, x_c = x.chunk(2)
+        self.update_convergence(x_u, x_c)
         x_pred = x_u + self.scale * (x_c - x_u)
         return x_pred
 
     def prepare_inputs(self, x, s, c, uc):
+        self.guidance_active = self.use_guidance(s)
+        if not self.guidance_active:
+            return x, s, dict(c)
+
         c_out = dict()
 
         for k in c:
@@ -64,6 +145,9 @@ class LinearPredictionGuider(Guider):
         num_frames: int,
         min_scale: float = 1.0,
         additional_cond_keys: Optional[Union[List[str], str]] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_stop: Optional[float] = None,
+        adaptive_threshold: Optional[float] = None,
     ):
         self.min_scale = min_scale
         self.max_scale = max_scale
@@ -74,9 +158,13 @@ class LinearPredictionGuider(Guider):
         if isinstance(additional_cond_keys, str):
             additional_cond_keys = [additional_cond_keys]
         self.additional_cond_keys = additional_cond_keys
+        self.set_guidance_interval(guidance_interval, guidance_stop, adaptive_threshold)
 
     def __call__(self, x: torch.Tensor, sigma: torch.Tensor) -> torch.Tensor:
+        if not self.guidance_active:
+            return x
         x_u, x_c = x.chunk(2)
+        self.update_convergence(x_u, x_c)
 
         x_u = rearrange(x_u, "(b t) ... -> b t ...", t=self.num_frames)
         x_c = rearrange(x_c, "(b t) ... -> b t ...", t=self.num_frames)
@@ -88,6 +176,10 @@ class LinearPredictionGuider(Guider):
     def prepare_inputs(
         self, x: torch.Tensor, s: torch.Tensor, c: dict, uc: dict
     ) -> Tuple[torch.Tensor, torch.Tensor, dict]:
+        self.guidance_active = self.use_guidance(s)
+        if not self.guidance_active:
+            return x, s, dict(c)
+
         c_out = dict()
 
         for k in c:
@@ -108,8 +200,19 @@ class TrianglePredictionGuider(LinearPredictionGuider):
         period: Union[float, List[float]] = 1.0,
         period_fusing: Literal["mean", "multiply", "max"] = "max",
         additional_cond_keys: Optional[Union[List[str], str]] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_stop: Optional[float] = None,
+        adaptive_threshold: Optional[float] = None,
     ):
-        super().__init__(max_scale, num_frames, min_scale, additional_cond_keys)
+        super().__init__(
+            max_scale,
+            num_frames,
+            min_scale,
+            additional_cond_keys,
+            guidance_interval,
+            guidance_stop,
+            adaptive_threshold,
+        )
         values = torch.linspace(0, 1, num_frames)
         # Constructs a triangle wave
         if isinstance(period, float):
@@ -139,8 +242,19 @@ class TrapezoidPredictionGuider(LinearPredictionGuider):
         min_scale: float = 1.0,
         edge_perc: float = 0.1,
         additional_cond_keys: Optional[Union[List[str], str]] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_stop: Optional[float] = None,
+        adaptive_threshold: Optional[float] = None,
     ):
-        super().__init__(max_scale, num_frames, min_scale, additional_cond_keys)
+        super().__init__(
+            max_scale,
+            num_frames,
+            min_scale,
+            additional_cond_keys,
+            guidance_interval,
+            guidance_stop,
+            adaptive_threshold,
+        )
 
         rise_steps = torch.linspace(min_scale, max_scale, int(num_frames * edge_perc))
         fall_steps = torch.flip(rise_steps, [0])
@@ -161,8 +275,19 @@ class SpatiotemporalPredictionGuider(LinearPredictionGuider):
         num_views: int = 1,
         min_scale: float = 1.0,
         additional_cond_keys: Optional[Union[List[str], str]] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_stop: Optional[float] = None,
+        adaptive_threshold: Optional[float] = None,
     ):
-        super().__init__(max_scale, num_frames, min_scale, additional_cond_keys)
+        super().__init__(
+            max_scale,
+            num_frames,
+            min_scale,
+            additional_cond_keys,
+            guidance_interval,
+            guidance_stop,
+            adaptive_threshold,
+        )
         V = num_views
         T = num_frames // V
         scale = torch.zeros(num_frames).view(T, V)
@@ -501,6 +501,74 @@ class Timestep(nn.Module):
         return timestep_embedding(t, self.dim)
 
 
+class DeepCache:
+    """
+    Cross-step feature cache for the UNet (DeepCache, https://arxiv.org/abs/2312.00858).
+    On "full" steps the whole UNet is evaluated and the features entering the last
+    `cache_branch + 1` output blocks are stored. On the following "shallow" steps only
+    input_blocks[: cache_branch + 1] and those output blocks are evaluated, and the
+    deep part of the network is replaced by the cached features.
+    :param cache_interval: every `cache_interval`-th sampler step is a full step.
+    :param cache_branch: index of the last input block on the shallow path.
+    :param full_steps: optional explicit collection of full step indices, overrides
+        `cache_interval`. Step 0 is always a full step.
+    """
+
+    def __init__(
+        self,
+        cache_interval: int = 3,
+        cache_branch: int = 1,
+        full_steps: Optional[Iterable[int]] = None,
+    ):
+        self.cache_interval = cache_interval
+        self.cache_branch = cache_branch
+        self.full_steps = set(full_steps) if full_steps is not None else None
+        self.reset()
+
+    def reset(self):
+        self.features = None
+        self.full = True
+
+    def set_step(self, step: int):
+        if step == 0:
+            self.full = True
+        elif self.full_steps is not None:
+            self.full = step in self.full_steps
+        else:
+            self.full = step % self.cache_interval == 0
+
+    def step_schedule(self, steps: Iterable[int]) -> Iterable[int]:
+        self.reset()
+        for step in steps:
+            self.set_step(step)
+            yield step
+        self.reset()
+
+    def use_cache(self, x: th.Tensor) -> bool:
+        return (
+            not self.full
+            and self.features is not None
+            and self.features.shape[0] == x.shape[0]
+        )
+
+
+def enable_deep_cache(
+    model: nn.Module,
+    cache_interval: int = 3,
+    cache_branch: int = 1,
+    full_steps: Optional[Iterable[int]] = None,
+) -> DeepCache:
+    """
+    Attaches a DeepCache to every UNet in `model` and returns it. Pass the returned
+    cache to the sampler (`sampler.deep_cache`) so that it drives the refresh schedule.
+    """
+    deep_cache = DeepCache(cache_interval, cache_branch, full_steps)
+    for module in model.modules():
+        if hasattr(module, "deep_cache"):
+            module.deep_cache = deep_cache
+    return deep_cache
+
+
 class UNetModel(nn.Module):
     """
     The full UNet model with attention and timestep embedding.
@@ -844,6 +912,7 @@ class UNetModel(nn.Module):
             nn.SiLU(),
             zero_module(conv_nd(dims, model_channels, out_channels, 3, padding=1)),
         )
+        self.deep_cache = None  # set by enable_deep_cache
 
     def forward(
         self,
@@ -872,12 +941,25 @@ class UNetModel(nn.Module):
             assert y.shape[0] == x.shape[0]
             emb = emb + self.label_emb(y)
 
+        deep_cache = self.deep_cache
+        use_cache = deep_cache is not None and deep_cache.use_cache(x)
+
         h = x
-        for module in self.input_blocks:
+        for i, module in enumerate(self.input_blocks):
             h = module(h, emb, context)
             hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+            if use_cache and i == deep_cache.cache_branch:
+                break
+        if use_cache:
+            # shallow step: the deep blocks are replaced by the cached features
+            h = deep_cache.features
+            output_blocks = self.output_blocks[-len(hs) :]
+        else:
+            h = self.middle_block(h, emb, context)
+            output_blocks = self.output_blocks
+        for module in output_blocks:
+            if deep_cache is not None and len(hs) == deep_cache.cache_branch + 1:
+                deep_cache.features = h
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         h = h.type(x.dtype)
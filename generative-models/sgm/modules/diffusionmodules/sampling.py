@@ -26,6 +26,7 @@ class BaseDiffusionSampler:
         guider_config: Union[Dict, ListConfig, OmegaConf, None] = None,
         verbose: bool = False,
         device: str = "cuda",
+        deep_cache=None,
     ):
         self.num_steps = num_steps
         self.discretization = instantiate_from_config(discretization_config)
@@ -37,12 +38,16 @@ class BaseDiffusionSampler:
         )
         self.verbose = verbose
         self.device = device
+        # optional openaimodel.DeepCache, refreshed according to the step index
+        self.deep_cache = deep_cache
 
     def prepare_sampling_loop(self, x, cond, uc=None, num_steps=None):
         sigmas = self.discretization(
             self.num_steps if num_steps is None else num_steps, device=self.device
         )
         uc = default(uc, cond)
+        # the guider may truncate guidance relative to the sigma schedule
+        self.guider.reset(sigmas)
 
         x *= torch.sqrt(1.0 + sigmas[0] ** 2.0)
         num_sigmas = len(sigmas)
@@ -68,6 +73,8 @@ class BaseDiffusionSampler:
                 total=num_sigmas,
                 desc=f"Sampling with {self.__class__.__name__} for {num_sigmas} steps",
             )
+        if self.deep_cache is not None:
+            sigma_generator = self.deep_cache.step_schedule(sigma_generator)
         return sigma_generator
 
 
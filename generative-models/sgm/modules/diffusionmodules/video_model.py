@@ -443,6 +443,7 @@ class VideoUNet(nn.Module):
             nn.SiLU(),
             zero_module(conv_nd(dims, model_channels, out_channels, 3, padding=1)),
         )
+        self.deep_cache = None  # set by enable_deep_cache
 
     def forward(
         self,
@@ -457,6 +458,11 @@ class VideoUNet(nn.Module):
         assert (y is not None) == (
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional -> no, relax this TODO"
+        if image_only_indicator is not None and num_video_frames is not None:
+            # guiders skip the unconditional half of the batch outside of their
+            # guidance interval
+            num_videos = x.shape[0] // num_video_frames
+            image_only_indicator = image_only_indicator[:num_videos]
         hs = []
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
         emb = self.time_embed(t_emb)
@@ -465,8 +471,11 @@ class VideoUNet(nn.Module):
             assert y.shape[0] == x.shape[0]
             emb = emb + self.label_emb(y)
 
+        deep_cache = self.deep_cache
+        use_cache = deep_cache is not None and deep_cache.use_cache(x)
+
         h = x
-        for module in self.input_blocks:
+        for i, module in enumerate(self.input_blocks):
             h = module(
                 h,
                 emb,
@@ -476,15 +485,25 @@ class VideoUNet(nn.Module):
                 num_video_frames=num_video_frames,
             )
             hs.append(h)
-        h = self.middle_block(
-            h,
-            emb,
-            context=context,
-            image_only_indicator=image_only_indicator,
-            time_context=time_context,
-            num_video_frames=num_video_frames,
-        )
-        for module in self.output_blocks:
+            if use_cache and i == deep_cache.cache_branch:
+                break
+        if use_cache:
+            # shallow step: the deep blocks are replaced by the cached features
+            h = deep_cache.features
+            output_blocks = self.output_blocks[-len(hs) :]
+        else:
+            h = self.middle_block(
+                h,
+                emb,
+                context=context,
+                image_only_indicator=image_only_indicator,
+                time_context=time_context,
+                num_video_frames=num_video_frames,
+            )
+            output_blocks = self.output_blocks
+        for module in output_blocks:
+            if deep_cache is not None and len(hs) == deep_cache.cache_branch + 1:
+                deep_cache.features = h
             h = th.cat([h, hs.pop()], dim=1)
             h = module(
                 h,
@@ -1184,6 +1203,11 @@ class SpatialUNetModelWithTime(nn.Module):
         assert (y is not None) == (
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional -> no, relax this TODO"
+        if image_only_indicator is not None and num_video_frames is not None:
+            # guiders skip the unconditional half of the batch outside of their
+            # guidance interval
+            num_videos = x.shape[0] // num_video_frames
+            image_only_indicator = image_only_indicator[:num_videos]
         hs = []
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False) # 21 x 320
         emb = self.time_embed(t_emb) # 21 x 1280
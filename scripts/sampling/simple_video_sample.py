@@ -17,6 +17,7 @@ from PIL import Image
 from rembg import remove
 from scripts.util.detection.nsfw_and_watermark_dectection import DeepFloydDataFiltering
 from sgm.inference.helpers import embed_watermark
+from sgm.modules.diffusionmodules.openaimodel import enable_deep_cache
 from sgm.util import default, instantiate_from_config
 from torchvision.transforms import ToTensor
 
@@ -37,10 +38,16 @@ def sample(
     azimuths_deg: Optional[List[float]] = None,  # For SV3D
     image_frame_ratio: Optional[float] = None,
     verbose: Optional[bool] = False,
+    deep_cache_interval: int = 1,  # > 1 reuses the deep UNet features for (interval - 1) steps after each full step
+    deep_cache_branch: int = 1,
+    guidance_stop: Optional[float] = None,  # fraction of the steps after which CFG is turned off
+    guidance_threshold: Optional[float] = None,  # turn CFG off once cond/uncond predictions converge
 ):
     """
     Simple script to generate a single sample conditioned on an image `input_path` or multiple images, one for each
     image file in folder `input_path`. If you run out of VRAM, try decreasing `decoding_t`.
+    For faster sampling, set `deep_cache_interval` to e.g. 3, and/or `guidance_stop` to e.g. 0.5 to skip the
+    unconditional pass on the last steps.
     """
 
     if version == "svd":
@@ -102,6 +109,13 @@ def sample(
         num_steps,
         verbose,
     )
+    if deep_cache_interval > 1:
+        model.sampler.deep_cache = enable_deep_cache(
+            model.model, cache_interval=deep_cache_interval, cache_branch=deep_cache_branch
+        )
+    model.sampler.guider.set_guidance_interval(
+        guidance_stop=guidance_stop, adaptive_threshold=guidance_threshold
+    )
     torch.manual_seed(seed)
 
     path = Path(input_path)